@@ -1,19 +1,44 @@
+import array
 import json
 import math
 import time
 import binascii
 import hashlib
 import os
+import usb_cdc
+
+try:
+    import supervisor
+except ImportError:
+    supervisor = None
 
 STARTUP_DELAY_SECONDS = 0.6
-time.sleep(STARTUP_DELAY_SECONDS)
+STARTUP_POLL_SECONDS = 0.01
+
+
+SERIAL_CHANNELS = tuple(
+    channel for channel in (usb_cdc.data, usb_cdc.console) if channel is not None
+)
+
+
+def wait_for_usb_serial(timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if supervisor is not None and supervisor.runtime.usb_connected:
+            return
+        for channel in SERIAL_CHANNELS:
+            if channel.connected:
+                return
+        time.sleep(STARTUP_POLL_SECONDS)
+
+
+wait_for_usb_serial(STARTUP_DELAY_SECONDS)
 
 from keybow2040 import Keybow2040, hsv_to_rgb
 # from keybow_hardware.pim56x import PIM56X as Hardware # for Keybow 2040
 from keybow_hardware.pim551 import PIM551 as Hardware  # for Pico RGB Keypad Base
 
 import usb_midi
-import usb_cdc
 import adafruit_midi
 from adafruit_midi.note_off import NoteOff
 from adafruit_midi.note_on import NoteOn
@@ -28,6 +53,9 @@ from midi_note_utils import clamp_note_range, filter_note_numbers
 
 keybow = Keybow2040(Hardware())
 keys = keybow.keys
+# LED writes bypass Key.set_led, so Key.rgb and Key.lit are never updated;
+# keybow's LED sleep and led_on must stay disabled with this write path.
+set_pixel = keybow.hardware.set_pixel
 
 BRIGHTNESS_SCALE = 0.9
 FIRMWARE_VERSION = "0.9.7"
@@ -37,19 +65,37 @@ FIRMWARE_ALLOWED_PATHS = ("/boot.py", "/code.py", "/midi_note_utils.py", "/proto
 
 NOTE_KEY_INDICES = tuple(range(12))
 BLACK_NOTE_INDICES = (1, 3, 6, 8, 10)
+BLACK_NOTE_FLAGS = bytes(1 if index in BLACK_NOTE_INDICES else 0 for index in NOTE_KEY_INDICES)
 MODIFIER_KEY_INDICES = (12, 13, 14, 15)
+MODIFIER_KEY_NAMES = tuple(str(index) for index in MODIFIER_KEY_INDICES)
 ALT_TOGGLE_KEY_INDEX = 12
 VELOCITY_KEY_INDEX = 13
 OCTAVE_DOWN_KEY_INDEX = 14
 OCTAVE_UP_KEY_INDEX = 15
 
+MODIFIER_KEYS = tuple(keys[index] for index in MODIFIER_KEY_INDICES)
+ALT_TOGGLE_KEY = keys[ALT_TOGGLE_KEY_INDEX]
+OCTAVE_DOWN_KEY = keys[OCTAVE_DOWN_KEY_INDEX]
+OCTAVE_UP_KEY = keys[OCTAVE_UP_KEY_INDEX]
+
 OSCILLATE_MIN = 10
 OSCILLATE_MAX = 140
 OSCILLATE_SPEED = 2.2
+OSCILLATE_SPAN = OSCILLATE_MAX - OSCILLATE_MIN
+OSCILLATE_LUT_SIZE = 256
+PRESET_BLEND_STEPS = 255
+GRADIENT_KEY_POSITIONS = tuple(
+    index / max(1, len(NOTE_KEY_INDICES) - 1) for index in NOTE_KEY_INDICES
+)
+RAIN_KEY_PHASES = tuple(index * 1.37 for index in NOTE_KEY_INDICES)
+OSCILLATE_LUT_MASK = OSCILLATE_LUT_SIZE - 1
+OSCILLATE_LUT_STEPS_PER_RADIAN = OSCILLATE_LUT_SIZE / (2 * math.pi)
 HANDSHAKE_ANIMATION_SPEED = 0.22
 IDLE_TIMEOUT_SECONDS = 30.0
+LED_FRAME_INTERVAL_SECONDS = 1.0 / 60.0
 FIRMWARE_RESET_DELAY_SECONDS = 1.0
 FIRMWARE_COPY_CHUNK_BYTES = 512
+SERIAL_READ_BLOCK_BYTES = 512
 
 ALT_ACTIVE_COLOR = (0, 0, 255)
 MODIFIER_ALT_IDLE_COLOR = (120, 120, 120)
@@ -61,6 +107,7 @@ BASE_NOTE_OFFSET = 0
 ALT_TOGGLE_WINDOW = 0.45
 
 VELOCITY_LEVELS = (127, 80, 40)
+NOTE_MESSAGE_CACHE_LIMIT = 48
 VELOCITY_COLORS = (
     (255, 0, 0),
     (0, 255, 0),
@@ -68,6 +115,7 @@ VELOCITY_COLORS = (
 )
 
 BASE_NOTES = tuple(range(60, 72))
+BASE_NOTE_BY_KEY_INDEX = BASE_NOTES + (None,) * len(MODIFIER_KEY_INDICES)
 MIN_OCTAVE_OFFSET = -36
 MAX_OCTAVE_OFFSET = 36
 MAX_CHORD_INTERVAL = 21
@@ -104,13 +152,29 @@ CHORD_INTERVALS_BY_NAME = {
     "min79": (0, 3, 7, 10, 14),
 }
 
-active_chord_notes = []
-active_notes = {}
+active_chord_slots = bytearray(len(NOTE_KEY_INDICES))
+NO_CHORD_SLOTS = bytes(len(NOTE_KEY_INDICES))
+active_chord_mask = 0
+active_notes = [None] * len(NOTE_KEY_INDICES)
+NO_ACTIVE_NOTES = (None,) * len(NOTE_KEY_INDICES)
+# Keys of active_notes in press order; chord slots follow this order.
+active_note_order = []
+key_held = bytearray(len(keys))
+held_key_count = 0
+held_note_key_count = 0
+note_message_cache = {}
 last_alt_press_time = None
 alt_mode_active = False
 octave_offset = 0
+note_offset = BASE_NOTE_OFFSET
 velocity_index = 0
 serial_buffer = bytearray()
+serial_read_block = bytearray(SERIAL_READ_BLOCK_BYTES)
+serial_read_view = memoryview(serial_read_block)
+serial_write_buffer = bytearray()
+led_state_cache = bytearray(3 * len(keys))
+note_leds_dirty = True
+last_note_led_tick = -1
 last_applied_idempotency_key = None
 last_applied_config_id = None
 acceptance_animation_queued = False
@@ -118,18 +182,22 @@ handshake_animation_active = False
 handshake_stop_pending = False
 idle_animation_active = False
 firmware_animation_active = False
-last_key_activity_monotonic = time.monotonic()
+loop_monotonic = time.monotonic()
+last_key_activity_monotonic = loop_monotonic
 firmware_update_session = None
 firmware_reset_queued = False
 firmware_reset_due_monotonic = 0.0
 
 device_state = None
-modifier_chord_types = {
-    15: "maj",
-    14: "min",
-    13: "maj7",
-    12: "min7",
-}
+note_preset_mode = "piano"
+piano_white_key_color = (150, 150, 150)
+piano_black_key_color = (70, 70, 110)
+piano_key_leds = ((0, 0, 0),) * len(NOTE_KEY_INDICES)
+gradient_blend_colors = ((0, 0, 0),) * (PRESET_BLEND_STEPS + 1)
+rain_blend_colors = ((0, 0, 0),) * (PRESET_BLEND_STEPS + 1)
+gradient_phase_rate = 0.18
+rain_phase_rate = 0.9
+chord_intervals_by_mask = [(0,)] * (1 << len(MODIFIER_KEYS))
 
 protocol_capabilities = {
     "device": DEVICE_NAME,
@@ -147,56 +215,174 @@ protocol_capabilities = {
 }
 
 
-midi = adafruit_midi.MIDI(midi_out=usb_midi.ports[1], out_channel=0)
+OSCILLATE_LUT = array.array(
+    "B",
+    [
+        int(
+            (
+                OSCILLATE_MIN
+                + int(OSCILLATE_SPAN * (math.sin(step / OSCILLATE_LUT_STEPS_PER_RADIAN) + 1) * 0.5)
+            )
+            * BRIGHTNESS_SCALE
+        )
+        for step in range(OSCILLATE_LUT_SIZE)
+    ],
+)
 
 
-def set_led_scaled(index, red, green, blue):
-    keybow.set_led(
-        index,
-        int(red * BRIGHTNESS_SCALE),
-        int(green * BRIGHTNESS_SCALE),
-        int(blue * BRIGHTNESS_SCALE),
+SINE_LUT = array.array(
+    "f", [math.sin(step / OSCILLATE_LUT_STEPS_PER_RADIAN) for step in range(OSCILLATE_LUT_SIZE)]
+)
+
+
+def lut_sin(radians):
+    return SINE_LUT[int(radians * OSCILLATE_LUT_STEPS_PER_RADIAN) & OSCILLATE_LUT_MASK]
+
+
+def _oscillation_phase_table(base_phases, count):
+    table = array.array("B")
+    for offset in range(count):
+        for base in base_phases:
+            table.append(int((base + offset) * OSCILLATE_LUT_STEPS_PER_RADIAN) & OSCILLATE_LUT_MASK)
+    return table
+
+
+NOTE_OSCILLATION_PHASES = _oscillation_phase_table((0.0, 2.1, 4.2), len(NOTE_KEY_INDICES))
+MODIFIER_OSCILLATION_PHASES = _oscillation_phase_table(
+    (0.6, 2.7, 4.8), len(MODIFIER_KEY_INDICES)
+)
+
+midi_out_port = usb_midi.ports[1]
+midi = adafruit_midi.MIDI(midi_out=midi_out_port, out_channel=0)
+send_midi_one = midi.send
+
+
+def _encode_midi_messages(messages):
+    packet = bytearray()
+    for message in messages:
+        message.channel = midi.out_channel
+        packet.extend(message.__bytes__())
+    return bytes(packet)
+
+
+note_on_pool = {}
+note_off_pool = {}
+
+
+def pooled_note_on(note, velocity):
+    pool_key = (velocity << 8) | note
+    message = note_on_pool.get(pool_key)
+    if message is None:
+        message = NoteOn(note, velocity)
+        note_on_pool[pool_key] = message
+    return message
+
+
+def pooled_note_off(note):
+    message = note_off_pool.get(note)
+    if message is None:
+        message = NoteOff(note, 0)
+        note_off_pool[note] = message
+    return message
+
+
+EMERGENCY_NOTE_OFF_PACKET = _encode_midi_messages(
+    [pooled_note_off(note) for note in EMERGENCY_NOTE_RANGE]
+)
+
+
+BRIGHTNESS_LUT = bytes(int(value * BRIGHTNESS_SCALE) for value in range(256))
+
+
+def scale_color(color):
+    return (
+        BRIGHTNESS_LUT[color[0]],
+        BRIGHTNESS_LUT[color[1]],
+        BRIGHTNESS_LUT[color[2]],
     )
 
 
-def oscillating_channel(time_value, phase):
-    span = OSCILLATE_MAX - OSCILLATE_MIN
-    return OSCILLATE_MIN + int(span * (math.sin(time_value + phase) + 1) / 2)
+def set_led_scaled(index, red, green, blue):
+    lut = BRIGHTNESS_LUT
+    set_led_prescaled(index, lut[red], lut[green], lut[blue])
+
+
+ALT_ACTIVE_LED = scale_color(ALT_ACTIVE_COLOR)
+MODIFIER_ALT_IDLE_LED = scale_color(MODIFIER_ALT_IDLE_COLOR)
+CHORD_IDENTIFIER_SOLID_LED = scale_color(CHORD_IDENTIFIER_SOLID_COLOR)
+VELOCITY_LEDS = tuple(scale_color(color) for color in VELOCITY_COLORS)
+
 
+def set_led_prescaled(index, red, green, blue, cache=led_state_cache, write=set_pixel):
+    offset = index * 3
+    if (
+        cache[offset] == red
+        and cache[offset + 1] == green
+        and cache[offset + 2] == blue
+    ):
+        return
 
-def note_to_key_index(note):
-    return (note - 60) % 12
+    cache[offset] = red
+    cache[offset + 1] = green
+    cache[offset + 2] = blue
+    write(index, red, green, blue)
 
 
-def current_note_offset():
-    return BASE_NOTE_OFFSET + octave_offset
+def oscillation_tick(time_value):
+    return int(time_value * OSCILLATE_LUT_STEPS_PER_RADIAN) & OSCILLATE_LUT_MASK
 
 
-def adjust_octave_offset(step):
-    global octave_offset
-    octave_offset = max(MIN_OCTAVE_OFFSET, min(MAX_OCTAVE_OFFSET, octave_offset + step))
+def set_led_oscillating(
+    index,
+    tick,
+    phases,
+    slot,
+    lut=OSCILLATE_LUT,
+    mask=OSCILLATE_LUT_MASK,
+    set_prescaled=set_led_prescaled,
+):
+    base = slot * 3
+    set_prescaled(
+        index,
+        lut[(tick + phases[base]) & mask],
+        lut[(tick + phases[base + 1]) & mask],
+        lut[(tick + phases[base + 2]) & mask],
+    )
 
 
-def send_midi(message):
-    if isinstance(message, list):
-        for msg in message:
-            midi.send(msg)
-    else:
-        midi.send(message)
+def adjust_octave_offset(step):
+    global octave_offset, note_offset
+    offset = octave_offset + step
+    if offset < MIN_OCTAVE_OFFSET:
+        offset = MIN_OCTAVE_OFFSET
+    elif offset > MAX_OCTAVE_OFFSET:
+        offset = MAX_OCTAVE_OFFSET
+    octave_offset = offset
+    note_offset = BASE_NOTE_OFFSET + offset
 
 
 def any_note_pressed():
-    for index in NOTE_KEY_INDICES:
-        if keys[index].pressed:
-            return True
-    return False
+    return held_note_key_count > 0
+
+
+def any_active_notes():
+    return active_notes.count(None) != len(active_notes)
 
 
 def any_key_pressed():
-    for index in range(len(keys)):
-        if keys[index].pressed:
-            return True
-    return False
+    return held_key_count > 0
+
+
+def set_key_held(index, held):
+    global held_key_count, held_note_key_count
+    if key_held[index] == held:
+        return
+
+    key_held[index] = held
+    step = 1 if held else -1
+    held_key_count += step
+    if BASE_NOTE_BY_KEY_INDEX[index] is not None:
+        held_note_key_count += step
 
 
 def mark_key_activity(now=None):
@@ -266,14 +452,24 @@ def persist_device_state(state):
         return False, "Unable to persist config: %s" % exc
 
 
-def snapshot_device_state():
-    return clone_device_state(device_state)
+def snapshot_device_state_for_wire():
+    # Returned by reference: device_state is replaced, never mutated.
+    return device_state
 
 
 def _firmware_stage_path(path):
     return "/.fw_stage_%s" % path.strip("/").replace("/", "_")
 
 
+def _close_stage_handle(metadata):
+    handle = metadata.get("handle")
+    if handle is None:
+        return
+
+    metadata["handle"] = None
+    handle.close()
+
+
 def _clear_firmware_stage_files(session):
     if not isinstance(session, dict):
         return
@@ -286,6 +482,11 @@ def _clear_firmware_stage_files(session):
         if not isinstance(metadata, dict):
             continue
 
+        try:
+            _close_stage_handle(metadata)
+        except OSError:
+            pass
+
         stage_path = metadata.get("stagePath")
         if not isinstance(stage_path, str):
             continue
@@ -297,13 +498,15 @@ def _clear_firmware_stage_files(session):
 
 
 def _copy_stage_file(stage_path, destination_path):
+    block = bytearray(FIRMWARE_COPY_CHUNK_BYTES)
+    block_view = memoryview(block)
     with open(stage_path, "rb") as source:
         with open(destination_path, "wb") as destination:
             while True:
-                chunk = source.read(FIRMWARE_COPY_CHUNK_BYTES)
-                if not chunk:
+                count = source.readinto(block)
+                if not count:
                     break
-                destination.write(chunk)
+                destination.write(block if count == FIRMWARE_COPY_CHUNK_BYTES else block_view[:count])
 
 
 def _firmware_error(code, reason, retryable=False):
@@ -343,14 +546,12 @@ def _hex_to_rgb(value, fallback):
         return fallback
 
     try:
-        return (
-            int(value[1:3], 16),
-            int(value[3:5], 16),
-            int(value[5:7], 16),
-        )
+        packed = int(value[1:], 16)
     except ValueError:
         return fallback
 
+    return ((packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF)
+
 
 def _lerp(start, end, amount):
     return start + (end - start) * amount
@@ -389,61 +590,66 @@ def _preset_speed(name):
     return float(speed)
 
 
-def _piano_note_color(index):
-    piano = device_state["notePreset"]["piano"]
-    white_key_color = _hex_to_rgb(piano["whiteKeyColor"], (150, 150, 150))
-    black_key_color = _hex_to_rgb(piano["blackKeyColor"], (70, 70, 110))
+def _piano_note_color(index, time_value):
+    if BLACK_NOTE_FLAGS[index]:
+        return piano_black_key_color
 
-    if index in BLACK_NOTE_INDICES:
-        return black_key_color
+    return piano_white_key_color
 
-    return white_key_color
+
+def _preset_blend_colors(name, fallback_a, fallback_b):
+    section = device_state["notePreset"][name]
+    color_a = _hex_to_rgb(section["colorA"], fallback_a)
+    color_b = _hex_to_rgb(section["colorB"], fallback_b)
+    return tuple(
+        _lerp_rgb(color_a, color_b, step / PRESET_BLEND_STEPS)
+        for step in range(PRESET_BLEND_STEPS + 1)
+    )
 
 
 def _gradient_note_color(index, time_value):
-    gradient = device_state["notePreset"]["gradient"]
-    color_a = _hex_to_rgb(gradient["colorA"], (255, 75, 90))
-    color_b = _hex_to_rgb(gradient["colorB"], (85, 155, 255))
-    speed = _preset_speed("gradient")
-
-    key_span = max(1, len(NOTE_KEY_INDICES) - 1)
-    base_position = index / key_span
-    offset = (time_value * 0.18 * speed) % 1.0
-    blend = (base_position + offset) % 1.0
+    offset = (time_value * gradient_phase_rate) % 1.0
+    blend = (GRADIENT_KEY_POSITIONS[index] + offset) % 1.0
 
-    return _lerp_rgb(color_a, color_b, blend)
+    return gradient_blend_colors[int(blend * PRESET_BLEND_STEPS)]
 
 
 def _rain_note_color(index, time_value):
-    rain = device_state["notePreset"]["rain"]
-    color_a = _hex_to_rgb(rain["colorA"], (86, 209, 141))
-    color_b = _hex_to_rgb(rain["colorB"], (85, 155, 255))
-    speed = _preset_speed("rain")
+    phase = (time_value * rain_phase_rate) + RAIN_KEY_PHASES[index]
+    color_mix = 0.5 + 0.5 * lut_sin(phase * 0.67 + lut_sin(phase * 0.21))
+    brightness = 0.35 + 0.65 * (0.5 + 0.5 * lut_sin(phase + lut_sin(phase * 0.41 + index)))
 
-    phase = (time_value * 0.9 * speed) + (index * 1.37)
-    color_mix = 0.5 + 0.5 * math.sin(phase * 0.67 + math.sin(phase * 0.21))
-    brightness = 0.35 + 0.65 * (0.5 + 0.5 * math.sin(phase + math.sin(phase * 0.41 + index)))
+    mix_step = int(max(0.0, min(1.0, color_mix)) * PRESET_BLEND_STEPS)
+    return _scale_rgb(rain_blend_colors[mix_step], brightness)
 
-    return _scale_rgb(_lerp_rgb(color_a, color_b, color_mix), brightness)
 
+NOTE_BASE_COLOR_BY_MODE = {
+    "piano": _piano_note_color,
+    "gradient": _gradient_note_color,
+    "rain": _rain_note_color,
+}
+note_base_color = _piano_note_color
 
-def note_base_color(index, time_value):
-    mode = device_state["notePreset"]["mode"]
-    if mode == "gradient":
-        return _gradient_note_color(index, time_value)
 
-    if mode == "rain":
-        return _rain_note_color(index, time_value)
+def set_note_base_led(index, time_value):
+    if note_preset_mode == "piano":
+        set_led_prescaled(index, *piano_key_leds[index])
+        return
 
-    return _piano_note_color(index)
+    set_led_scaled(index, *note_base_color(index, time_value))
 
 
 def restore_note_led(index):
-    now = time.monotonic() * OSCILLATE_SPEED
-    set_led_scaled(index, *note_base_color(index, now))
+    set_note_base_led(index, loop_monotonic * OSCILLATE_SPEED)
 
 
 def paint_base_note_leds(time_value):
+    if note_preset_mode == "piano":
+        for index in NOTE_KEY_INDICES:
+            red, green, blue = piano_key_leds[index]
+            set_led_prescaled(index, red, green, blue)
+        return
+
     for index in NOTE_KEY_INDICES:
         set_led_scaled(index, *note_base_color(index, time_value))
 
@@ -453,38 +659,60 @@ def paint_modifier_base_leds():
         set_led_scaled(index, 0, 0, 0)
 
 
+def mark_note_leds_dirty():
+    global note_leds_dirty
+    note_leds_dirty = True
+
+
 def paint_idle_layout(time_value):
+    mark_note_leds_dirty()
     paint_base_note_leds(time_value)
     paint_modifier_base_leds()
 
 
-def set_active_chord_notes(notes):
-    previous_notes = list(active_chord_notes)
-    active_chord_notes.clear()
-    for note in notes:
-        index = note_to_key_index(note)
-        if index not in active_chord_notes:
-            active_chord_notes.append(index)
-
-    for index in previous_notes:
-        if index not in active_chord_notes:
+def restore_released_chord_leds(released_mask):
+    for index in NOTE_KEY_INDICES:
+        if released_mask & (1 << index):
             restore_note_led(index)
 
 
 def clear_active_chord_notes():
-    for index in active_chord_notes:
-        restore_note_led(index)
-    active_chord_notes.clear()
+    global active_chord_mask
+    mark_note_leds_dirty()
+    released_mask = active_chord_mask
+    if not released_mask:
+        return
+
+    active_chord_mask = 0
+    active_chord_slots[:] = NO_CHORD_SLOTS
+    restore_released_chord_leds(released_mask)
 
 
 def refresh_active_chord_notes():
-    notes = []
-    for note_list in active_notes.values():
-        notes.extend(note_list)
-    set_active_chord_notes(notes)
+    # Slots are 1-based chord positions; 0 = not part of the chord.
+    global active_chord_mask
+    mark_note_leds_dirty()
+    previous_mask = active_chord_mask
+    active_chord_slots[:] = NO_CHORD_SLOTS
+
+    mask = 0
+    slot = 0
+    for key_index in active_note_order:
+        for index in active_notes[key_index][0]:
+            bit = 1 << index
+            if not mask & bit:
+                mask |= bit
+                slot += 1
+                active_chord_slots[index] = slot
+
+    active_chord_mask = mask
+    released_mask = previous_mask & ~mask
+    if released_mask:
+        restore_released_chord_leds(released_mask)
 
 
 def update_handshake_animation(time_value):
+    mark_note_leds_dirty()
     for index in range(16):
         hue = (index / 16.0 + (time_value * HANDSHAKE_ANIMATION_SPEED)) % 1.0
         red, green, blue = hsv_to_rgb(hue, 1.0, 1.0)
@@ -547,74 +775,93 @@ def maybe_run_queued_acceptance_animation():
 
 
 def apply_device_state_runtime(state):
-    global device_state, modifier_chord_types
+    global device_state, chord_intervals_by_mask
+    global piano_white_key_color, piano_black_key_color, piano_key_leds, note_preset_mode
+    global gradient_blend_colors, rain_blend_colors
+    global gradient_phase_rate, rain_phase_rate, note_base_color
 
     device_state = clone_device_state(state)
-    modifier_chords = device_state["modifierChords"]
-    modifier_chord_types = {
-        12: modifier_chords["12"],
-        13: modifier_chords["13"],
-        14: modifier_chords["14"],
-        15: modifier_chords["15"],
-    }
+    note_preset_mode = device_state["notePreset"]["mode"]
+    piano = device_state["notePreset"]["piano"]
+    piano_white_key_color = _hex_to_rgb(piano["whiteKeyColor"], (150, 150, 150))
+    piano_black_key_color = _hex_to_rgb(piano["blackKeyColor"], (70, 70, 110))
+    white_key_led = scale_color(piano_white_key_color)
+    black_key_led = scale_color(piano_black_key_color)
+    piano_key_leds = tuple(
+        black_key_led if BLACK_NOTE_FLAGS[index] else white_key_led
+        for index in NOTE_KEY_INDICES
+    )
+    gradient_blend_colors = _preset_blend_colors("gradient", (255, 75, 90), (85, 155, 255))
+    rain_blend_colors = _preset_blend_colors("rain", (86, 209, 141), (85, 155, 255))
+    gradient_phase_rate = 0.18 * _preset_speed("gradient")
+    rain_phase_rate = 0.9 * _preset_speed("rain")
+    note_base_color = NOTE_BASE_COLOR_BY_MODE.get(note_preset_mode, _piano_note_color)
+    chord_intervals_by_mask = build_chord_intervals_by_mask(device_state["modifierChords"])
+    note_message_cache.clear()
 
     paint_idle_layout(time.monotonic() * OSCILLATE_SPEED)
     refresh_active_chord_notes()
 
 
-def update_modifier_leds(time_value):
-    if alt_mode_active:
-        hue = (time_value * OCTAVE_IDLE_GRADIENT_SPEED) % 1.0
-        down_idle_color = hsv_to_rgb(hue, 1.0, 1.0)
-        up_idle_color = hsv_to_rgb((hue + OCTAVE_IDLE_GRADIENT_HUE_OFFSET) % 1.0, 1.0, 1.0)
-        up_color = CHORD_IDENTIFIER_SOLID_COLOR if keys[OCTAVE_UP_KEY_INDEX].pressed else up_idle_color
-        down_color = (
-            CHORD_IDENTIFIER_SOLID_COLOR if keys[OCTAVE_DOWN_KEY_INDEX].pressed else down_idle_color
-        )
-        exit_color = (
-            ALT_ACTIVE_COLOR
-            if keys[ALT_TOGGLE_KEY_INDEX].pressed
-            else MODIFIER_ALT_IDLE_COLOR
-        )
-        set_led_scaled(OCTAVE_UP_KEY_INDEX, *up_color)
-        set_led_scaled(OCTAVE_DOWN_KEY_INDEX, *down_color)
-        set_led_scaled(VELOCITY_KEY_INDEX, *VELOCITY_COLORS[velocity_index])
-        set_led_scaled(ALT_TOGGLE_KEY_INDEX, *exit_color)
-        return
-
-    for offset, index in enumerate(MODIFIER_KEY_INDICES):
-        set_led_scaled(
-            index,
-            oscillating_channel(time_value, 0.6 + offset),
-            oscillating_channel(time_value, 2.7 + offset),
-            oscillating_channel(time_value, 4.8 + offset),
-        )
+def update_alt_modifier_leds(time_value):
+    hue = (time_value * OCTAVE_IDLE_GRADIENT_SPEED) % 1.0
+    if OCTAVE_UP_KEY.pressed:
+        set_led_prescaled(OCTAVE_UP_KEY_INDEX, *CHORD_IDENTIFIER_SOLID_LED)
+    else:
+        up_hue = (hue + OCTAVE_IDLE_GRADIENT_HUE_OFFSET) % 1.0
+        set_led_scaled(OCTAVE_UP_KEY_INDEX, *hsv_to_rgb(up_hue, 1.0, 1.0))
+    if OCTAVE_DOWN_KEY.pressed:
+        set_led_prescaled(OCTAVE_DOWN_KEY_INDEX, *CHORD_IDENTIFIER_SOLID_LED)
+    else:
+        set_led_scaled(OCTAVE_DOWN_KEY_INDEX, *hsv_to_rgb(hue, 1.0, 1.0))
+    set_led_prescaled(VELOCITY_KEY_INDEX, *VELOCITY_LEDS[velocity_index])
+    exit_led = ALT_ACTIVE_LED if ALT_TOGGLE_KEY.pressed else MODIFIER_ALT_IDLE_LED
+    set_led_prescaled(ALT_TOGGLE_KEY_INDEX, *exit_led)
 
 
 def update_note_leds(time_value):
-    mode = device_state["notePreset"]["mode"]
-    active_offsets = {}
-    for offset, index in enumerate(active_chord_notes):
-        active_offsets[index] = offset
-
-    for index in NOTE_KEY_INDICES:
-        offset = active_offsets.get(index)
-        if offset is None:
-            set_led_scaled(index, *note_base_color(index, time_value))
-            continue
+    global note_leds_dirty, last_note_led_tick
 
-        if mode == "piano":
-            set_led_scaled(
-                index,
-                oscillating_channel(time_value, 0.0 + offset),
-                oscillating_channel(time_value, 2.1 + offset),
-                oscillating_channel(time_value, 4.2 + offset),
-            )
-            continue
+    mode = note_preset_mode
+    tick = oscillation_tick(time_value)
+    if mode == "piano" and not alt_mode_active:
+        if tick == last_note_led_tick and not note_leds_dirty:
+            return
+        note_leds_dirty = False
+        last_note_led_tick = tick
+    else:
+        last_note_led_tick = -1
+
+    set_prescaled = set_led_prescaled
+    set_oscillating = set_led_oscillating
+    slots = active_chord_slots
+    if mode == "piano":
+        base_leds = piano_key_leds
+        phases = NOTE_OSCILLATION_PHASES
+        for index in NOTE_KEY_INDICES:
+            slot = slots[index]
+            if slot:
+                set_oscillating(index, tick, phases, slot - 1)
+            else:
+                red, green, blue = base_leds[index]
+                set_prescaled(index, red, green, blue)
+    else:
+        set_scaled = set_led_scaled
+        base_color = note_base_color
+        red, green, blue = CHORD_IDENTIFIER_SOLID_LED
+        for index in NOTE_KEY_INDICES:
+            if slots[index]:
+                set_prescaled(index, red, green, blue)
+            else:
+                set_scaled(index, *base_color(index, time_value))
 
-        set_led_scaled(index, *CHORD_IDENTIFIER_SOLID_COLOR)
+    if alt_mode_active:
+        update_alt_modifier_leds(time_value)
+        return
 
-    update_modifier_leds(time_value)
+    phases = MODIFIER_OSCILLATION_PHASES
+    for offset, index in enumerate(MODIFIER_KEY_INDICES):
+        set_oscillating(index, tick, phases, offset)
 
 
 def maybe_start_idle_animation(now):
@@ -622,7 +869,7 @@ def maybe_start_idle_animation(now):
     if handshake_animation_active or idle_animation_active or firmware_animation_active:
         return
 
-    if active_notes or any_key_pressed():
+    if any_active_notes() or any_key_pressed():
         return
 
     if now - last_key_activity_monotonic >= IDLE_TIMEOUT_SECONDS:
@@ -631,13 +878,14 @@ def maybe_start_idle_animation(now):
 
 def roll_chord(messages, delay=0.012):
     for message in messages:
-        send_midi(message)
+        send_midi_one(message)
         time.sleep(delay)
 
 
 def emergency_note_off():
-    send_midi([NoteOff(note, 0) for note in EMERGENCY_NOTE_RANGE])
-    active_notes.clear()
+    midi_out_port.write(EMERGENCY_NOTE_OFF_PACKET, len(EMERGENCY_NOTE_OFF_PACKET))
+    active_notes[:] = NO_ACTIVE_NOTES
+    active_note_order.clear()
     clear_active_chord_notes()
 
 
@@ -649,7 +897,7 @@ def protocol_get_state():
     global handshake_stop_pending
     if handshake_animation_active:
         handshake_stop_pending = True
-    return snapshot_device_state()
+    return snapshot_device_state_for_wire()
 
 
 def protocol_apply_config(config, config_id, idempotency_key):
@@ -658,7 +906,7 @@ def protocol_apply_config(config, config_id, idempotency_key):
     if idempotency_key == last_applied_idempotency_key:
         return {
             "ok": True,
-            "state": snapshot_device_state(),
+            "state": snapshot_device_state_for_wire(),
             "appliedConfigId": last_applied_config_id or config_id,
         }
 
@@ -691,7 +939,7 @@ def protocol_apply_config(config, config_id, idempotency_key):
 
     return {
         "ok": True,
-        "state": snapshot_device_state(),
+        "state": snapshot_device_state_for_wire(),
         "appliedConfigId": config_id,
     }
 
@@ -722,6 +970,7 @@ def protocol_firmware_begin(session_id, target_version, files):
             "hasher": _create_sha256_hasher(),
             "complete": False,
             "stageReady": False,
+            "handle": None,
         }
 
     firmware_update_session = {
@@ -750,6 +999,12 @@ def protocol_firmware_chunk(session_id, path, chunk_index, data_base64):
     if chunk_index != metadata.get("nextChunkIndex"):
         return _firmware_error("invalid_firmware_update", "Unexpected firmware chunk index.")
 
+    text_length = len(data_base64)
+    if text_length % 4 == 0:
+        decoded_length = (text_length >> 2) * 3 - data_base64.count("=", text_length - 2)
+        if metadata["receivedBytes"] + decoded_length > metadata["expectedSize"]:
+            return _firmware_error("invalid_firmware_update", "Firmware file exceeded declared size.")
+
     try:
         chunk = binascii.a2b_base64(data_base64)
     except Exception:
@@ -758,22 +1013,29 @@ def protocol_firmware_chunk(session_id, path, chunk_index, data_base64):
     if len(chunk) == 0:
         return _firmware_error("invalid_firmware_update", "Firmware chunk cannot be empty.")
 
-    stage_path = metadata["stagePath"]
-    if not metadata.get("stageReady"):
-        try:
-            with open(stage_path, "wb") as handle:
-                handle.write(b"")
-        except OSError:
-            return _firmware_error("firmware_storage_error", "Unable to allocate stage file.", True)
-        metadata["stageReady"] = True
+    received_bytes = metadata["receivedBytes"] + len(chunk)
+    if received_bytes > metadata["expectedSize"]:
+        return _firmware_error("invalid_firmware_update", "Firmware file exceeded declared size.")
 
+    # The stage file stays open across chunks; the first chunk truncates it.
+    stage_ready = metadata.get("stageReady")
     try:
-        with open(stage_path, "ab") as handle:
-            handle.write(chunk)
+        handle = metadata.get("handle")
+        if handle is None:
+            handle = open(metadata["stagePath"], "ab" if stage_ready else "wb")
+            metadata["handle"] = handle
+        handle.write(chunk)
     except OSError:
+        try:
+            _close_stage_handle(metadata)
+        except OSError:
+            pass
+        if not stage_ready:
+            return _firmware_error("firmware_storage_error", "Unable to allocate stage file.", True)
         return _firmware_error("firmware_storage_error", "Unable to persist firmware chunk.", True)
+    metadata["stageReady"] = True
 
-    metadata["receivedBytes"] += len(chunk)
+    metadata["receivedBytes"] = received_bytes
     metadata["nextChunkIndex"] += 1
     hasher = metadata.get("hasher")
     if hasher is not None:
@@ -789,6 +1051,11 @@ def protocol_firmware_file_complete(session_id, path, size, sha256):
     if not isinstance(metadata, dict):
         return _firmware_error("invalid_firmware_update", "Unknown firmware file path.")
 
+    try:
+        _close_stage_handle(metadata)
+    except OSError:
+        return _firmware_error("firmware_storage_error", "Unable to persist firmware chunk.", True)
+
     received_bytes = metadata.get("receivedBytes", 0)
     expected_size = metadata.get("expectedSize", 0)
     if size != received_bytes or expected_size != received_bytes:
@@ -859,35 +1126,36 @@ def protocol_on_handshake():
     firmware_animation_active = False
 
 
-def active_serial_channel():
-    if usb_cdc.data is not None and usb_cdc.data.connected:
-        return usb_cdc.data
-
-    if usb_cdc.console is not None and usb_cdc.console.connected:
-        return usb_cdc.console
-
-    return None
-
-
 def poll_serial():
-    channel = active_serial_channel()
-    if channel is None:
+    for channel in SERIAL_CHANNELS:
+        if not channel.connected:
+            continue
+        waiting = channel.in_waiting
+        if waiting:
+            count = channel.readinto(serial_read_view[: min(waiting, SERIAL_READ_BLOCK_BYTES)]) or 0
+            if count:
+                process_serial_chunk(
+                    serial_buffer,
+                    serial_read_block,
+                    protocol_context,
+                    protocol_now_ms(),
+                    count,
+                    serial_write_buffer,
+                )
+                if serial_write_buffer:
+                    channel.write(serial_write_buffer)
+                    serial_write_buffer[:] = b""
+        break
+    else:
         return
 
-    chunk = b""
-    waiting = channel.in_waiting
-    if waiting:
-        chunk = channel.read(waiting) or b""
-
-    responses = process_serial_chunk(serial_buffer, chunk, protocol_context, protocol_now_ms())
-    for response in responses:
-        channel.write(response)
-
     if handshake_animation_active and handshake_stop_pending:
         stop_handshake_animation()
 
-    maybe_run_queued_acceptance_animation()
-    maybe_run_firmware_reset()
+    if acceptance_animation_queued:
+        maybe_run_queued_acceptance_animation()
+    if firmware_reset_queued:
+        maybe_run_firmware_reset()
 
 
 def maybe_run_firmware_reset():
@@ -910,60 +1178,91 @@ def maybe_run_firmware_reset():
         pass
 
 
-def chord_intervals():
+def held_chord_mask():
     if alt_mode_active:
-        return (0,)
+        return 0
+
+    mask = 0
+    bit = 1
+    for key in MODIFIER_KEYS:
+        if key.pressed:
+            mask |= bit
+        bit <<= 1
+    return mask
 
-    pressed_modifiers = [index for index in MODIFIER_KEY_INDICES if keys[index].pressed]
-    if len(pressed_modifiers) == 1:
-        chord_name = modifier_chord_types.get(pressed_modifiers[0])
-        if chord_name:
-            return CHORD_INTERVALS_BY_NAME.get(chord_name, (0,))
 
-    return (0,)
+def build_chord_intervals_by_mask(modifier_chords):
+    table = [(0,)] * (1 << len(MODIFIER_KEYS))
+    for bit, key_name in enumerate(MODIFIER_KEY_NAMES):
+        chord_name = modifier_chords.get(key_name)
+        if chord_name:
+            table[1 << bit] = CHORD_INTERVALS_BY_NAME.get(chord_name, (0,))
+    return table
+
+
+def note_messages(root_note, chord_mask, velocity):
+    # root_note and velocity are both 0-127, so the key packs into one int.
+    cache_key = (chord_mask << 16) | (velocity << 8) | root_note
+    messages = note_message_cache.get(cache_key)
+    if messages is not None:
+        return messages
+
+    intervals = chord_intervals_by_mask[chord_mask]
+    note_numbers = tuple(filter_note_numbers([root_note + interval for interval in intervals]))
+    messages = (
+        bytes((note - 60) % 12 for note in note_numbers),
+        tuple(pooled_note_on(note, velocity) for note in note_numbers),
+        _encode_midi_messages([pooled_note_off(note) for note in note_numbers]),
+    )
+    if len(note_message_cache) >= NOTE_MESSAGE_CACHE_LIMIT:
+        note_message_cache.clear()
+    note_message_cache[cache_key] = messages
+    return messages
 
 
 def handle_note_press(key_index, base_note):
     global last_alt_press_time
     last_alt_press_time = None
 
-    intervals = chord_intervals()
-    if intervals is None:
-        return
-
-    note_offset = current_note_offset()
-    note_numbers = filter_note_numbers(
-        [base_note + note_offset + interval for interval in intervals]
+    messages = note_messages(
+        base_note + note_offset,
+        held_chord_mask(),
+        VELOCITY_LEVELS[velocity_index],
     )
-    if len(note_numbers) == 0:
+    note_on_messages = messages[1]
+    if len(note_on_messages) == 0:
         return
 
-    velocity = VELOCITY_LEVELS[velocity_index]
-
-    if len(note_numbers) == 1:
-        send_midi(NoteOn(note_numbers[0], velocity))
+    if len(note_on_messages) == 1:
+        send_midi_one(note_on_messages[0])
     else:
-        roll_chord([NoteOn(note, velocity) for note in note_numbers])
+        roll_chord(note_on_messages)
 
-    active_notes[key_index] = note_numbers
+    if active_notes[key_index] is None:
+        active_note_order.append(key_index)
+    active_notes[key_index] = messages
     refresh_active_chord_notes()
 
 
 def handle_note_release(key_index):
-    note_numbers = active_notes.pop(key_index, None)
-    if not note_numbers:
+    messages = active_notes[key_index]
+    if messages is None:
         return
 
-    messages = [NoteOff(note, 0) for note in note_numbers]
-    send_midi(messages if len(messages) > 1 else messages[0])
+    active_notes[key_index] = None
+    active_note_order.remove(key_index)
+
+    note_off_packet = messages[2]
+    midi_out_port.write(note_off_packet, len(note_off_packet))
     refresh_active_chord_notes()
 
 
 def handle_alt_toggle():
     global alt_mode_active, last_alt_press_time
 
-    now = time.monotonic()
+    now = loop_monotonic
     if alt_mode_active:
+        mark_note_leds_dirty()
         alt_mode_active = False
         last_alt_press_time = None
         return
@@ -996,6 +1295,11 @@ def handle_alt_modifier_press(index):
 
 
 def initialize_runtime_state():
+    # A soft reload can leave the previous run's colours on the LEDs; clear
+    # them directly so the hardware matches the zeroed led_state_cache.
+    for index in range(len(keys)):
+        set_pixel(index, 0, 0, 0)
+
     loaded_state = load_device_state()
     apply_device_state_runtime(loaded_state)
 
@@ -1014,44 +1318,60 @@ protocol_context = {
     "on_handshake": protocol_on_handshake,
 }
 
-for index, base_note in enumerate(BASE_NOTES):
-    key = keys[index]
-
-    @keybow.on_press(key)
-    def press_handler(key, index=index, base_note=base_note):
-        mark_key_activity()
+def handle_key_press(key):
+    mark_key_activity(loop_monotonic)
+    index = key.number
+    set_key_held(index, 1)
+    base_note = BASE_NOTE_BY_KEY_INDEX[index]
+    if base_note is not None:
         handle_note_press(index, base_note)
-
-    @keybow.on_release(key)
-    def release_handler(key, index=index):
-        mark_key_activity()
-        handle_note_release(index)
-
-
-for index in MODIFIER_KEY_INDICES:
-    key = keys[index]
-
-    @keybow.on_press(key)
-    def press_handler(key, index=index):
-        mark_key_activity()
-        if index == ALT_TOGGLE_KEY_INDEX:
-            handle_alt_toggle()
-            return
+    elif index == ALT_TOGGLE_KEY_INDEX:
+        handle_alt_toggle()
+    else:
         handle_alt_modifier_press(index)
 
-    @keybow.on_release(key)
-    def release_handler(key):
-        mark_key_activity()
-        if not alt_mode_active:
-            emergency_note_off()
 
+def handle_key_release(key):
+    mark_key_activity(loop_monotonic)
+    index = key.number
+    set_key_held(index, 0)
+    if BASE_NOTE_BY_KEY_INDEX[index] is not None:
+        handle_note_release(index)
+    elif not alt_mode_active:
+        emergency_note_off()
 
-while True:
-    keybow.update()
-    now = time.monotonic()
-    maybe_start_idle_animation(now)
-    if handshake_animation_active or idle_animation_active or firmware_animation_active:
-        update_handshake_animation(now)
-    else:
-        update_note_leds(now * OSCILLATE_SPEED)
-    poll_serial()
+
+for key in keys:
+    keybow.on_press(key, handle_key_press)
+    keybow.on_release(key, handle_key_release)
+
+
+def run_main_loop():
+    global loop_monotonic
+
+    # The animation flags stay global reads: handlers flip them mid-loop.
+    update_keys = keybow.update
+    monotonic = time.monotonic
+    start_idle = maybe_start_idle_animation
+    animate_transport = update_handshake_animation
+    animate_notes = update_note_leds
+    poll = poll_serial
+    oscillate_speed = OSCILLATE_SPEED
+    frame_interval = LED_FRAME_INTERVAL_SECONDS
+    next_frame_due = 0.0
+
+    while True:
+        now = monotonic()
+        loop_monotonic = now
+        update_keys()
+        start_idle(now)
+        if now >= next_frame_due:
+            next_frame_due = now + frame_interval
+            if handshake_animation_active or idle_animation_active or firmware_animation_active:
+                animate_transport(now)
+            else:
+                animate_notes(now * oscillate_speed)
+        poll()
+
+
+run_main_loop()
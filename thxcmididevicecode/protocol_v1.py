@@ -8,6 +8,8 @@ ERROR_MALFORMED_FRAME = "malformed_frame"
 ERROR_UNSUPPORTED_VERSION = "unsupported_version"
 ERROR_UNSUPPORTED_TYPE = "unsupported_type"
 
+JSON_VALUE_START_CHARS = '{["-0123456789tfnNI'
+
 ALLOWED_CHORD_TYPES = (
     "maj",
     "min",
@@ -37,6 +39,9 @@ ALLOWED_CHORD_TYPES = (
 REQUIRED_MODIFIER_KEYS = ("12", "13", "14", "15")
 ALLOWED_NOTE_PRESET_MODES = ("piano", "gradient", "rain")
 HEX_DIGITS = "0123456789abcdefABCDEF"
+LOWER_HEX_DIGITS = "0123456789abcdef"
+_ALLOWED_CHORD_TYPES = frozenset(ALLOWED_CHORD_TYPES)
+_ALLOWED_NOTE_PRESET_MODES = frozenset(ALLOWED_NOTE_PRESET_MODES)
 MIN_PRESET_SPEED = 0.2
 MAX_PRESET_SPEED = 3.0
 
@@ -69,14 +74,28 @@ def default_device_state():
     }
 
 
+_DEFAULT_NOTE_PRESET = default_device_state()["notePreset"]
+_DEFAULT_PIANO = _DEFAULT_NOTE_PRESET["piano"]
+_DEFAULT_GRADIENT = _DEFAULT_NOTE_PRESET["gradient"]
+_DEFAULT_RAIN = _DEFAULT_NOTE_PRESET["rain"]
+
+
+_ENVELOPE_TEMPLATE = {
+    "v": PROTOCOL_VERSION,
+    "type": None,
+    "id": None,
+    "ts": None,
+    "payload": None,
+}
+
+
 def make_envelope(message_type, message_id, payload, ts_ms):
-    return {
-        "v": PROTOCOL_VERSION,
-        "type": message_type,
-        "id": message_id,
-        "ts": ts_ms,
-        "payload": payload,
-    }
+    envelope = _ENVELOPE_TEMPLATE.copy()
+    envelope["type"] = message_type
+    envelope["id"] = message_id
+    envelope["ts"] = ts_ms
+    envelope["payload"] = payload
+    return envelope
 
 
 def make_error(message_id, code, message, details, ts_ms):
@@ -88,7 +107,7 @@ def make_error(message_id, code, message, details, ts_ms):
 
 def make_ack(message_id, request_type, ts_ms, extra_payload=None):
     payload = {"requestType": request_type, "status": "ok"}
-    if isinstance(extra_payload, dict):
+    if type(extra_payload) is dict:
         payload.update(extra_payload)
     return make_envelope("ack", message_id, payload, ts_ms)
 
@@ -103,12 +122,57 @@ def make_nack(message_id, request_type, code, reason, retryable, ts_ms):
     return make_envelope("nack", message_id, payload, ts_ms)
 
 
+def _dump_frame_bytes(frame):
+    return json.dumps(frame, separators=(",", ":")).encode("utf-8")
+
+
 def encode_frame(frame):
-    return (json.dumps(frame, separators=(",", ":")) + "\n").encode("utf-8")
+    return _dump_frame_bytes(frame) + b"\n"
+
+
+def _static_error_frame(message, details=None):
+    # (prefix, suffix) around ts; bytes match encode_frame(make_error(...)).
+    prefix = ('{"v":%d,"type":"error","id":' % PROTOCOL_VERSION).encode("utf-8")
+    payload = {"code": ERROR_MALFORMED_FRAME, "message": message}
+    if details is not None:
+        payload["details"] = details
+    return (
+        prefix + _dump_frame_bytes(UNMATCHED_ID) + b',"ts":',
+        b',"payload":' + _dump_frame_bytes(payload) + b"}\n",
+    )
+
+
+_EMPTY_FRAME_ERROR = _static_error_frame("Frame is empty.")
+_NON_UTF8_FRAME_ERROR = _static_error_frame("Frame is not valid UTF-8.")
+_UNTERMINATED_FRAME_ERROR = _static_error_frame(
+    "Missing newline terminator before max frame size.",
+    {"maxFrameSize": MAX_FRAME_SIZE},
+)
+
+
+def _emit_static_error(static_frame, ts_ms, responses, out):
+    prefix, suffix = static_frame
+    ts_bytes = str(ts_ms).encode("utf-8")
+    if out is None:
+        responses.append(prefix + ts_bytes + suffix)
+        return
+
+    out.extend(prefix)
+    out.extend(ts_bytes)
+    out.extend(suffix)
+
+
+def _emit_frame(frame, responses, out):
+    if out is None:
+        responses.append(encode_frame(frame))
+        return
+
+    out.extend(_dump_frame_bytes(frame))
+    out.append(0x0A)
 
 
 def _extract_message_id(candidate):
-    if isinstance(candidate, dict):
+    if type(candidate) is dict:
         message_id = candidate.get("id")
         if isinstance(message_id, str) and message_id:
             return message_id
@@ -116,29 +180,15 @@ def _extract_message_id(candidate):
 
 
 def _is_object(value):
-    return isinstance(value, dict)
+    return type(value) is dict
 
 
 def _is_hex_color(value):
-    if not isinstance(value, str) or len(value) != 7 or not value.startswith("#"):
-        return False
-
-    for char in value[1:]:
-        if char not in HEX_DIGITS:
-            return False
-
-    return True
+    return isinstance(value, str) and len(value) == 7 and value.rstrip(HEX_DIGITS) == "#"
 
 
 def _is_hex_digest_64(value):
-    if not isinstance(value, str) or len(value) != 64:
-        return False
-
-    for char in value:
-        if char not in HEX_DIGITS:
-            return False
-
-    return True
+    return isinstance(value, str) and len(value) == 64 and not value.rstrip(HEX_DIGITS)
 
 
 def _normalize_hex_color(value, fallback):
@@ -148,48 +198,63 @@ def _normalize_hex_color(value, fallback):
 
 
 def _is_valid_speed(value):
-    return isinstance(value, (int, float)) and MIN_PRESET_SPEED <= value <= MAX_PRESET_SPEED
+    value_type = type(value)
+    return (
+        (value_type is float or value_type is int)
+        and MIN_PRESET_SPEED <= value <= MAX_PRESET_SPEED
+    )
 
 
 def _normalize_speed(value, fallback):
-    if not isinstance(value, (int, float)):
+    value_type = type(value)
+    if value_type is not float and value_type is not int:
         return fallback
 
     if value < MIN_PRESET_SPEED:
         return MIN_PRESET_SPEED
-
-    if value > MAX_PRESET_SPEED:
+    elif value > MAX_PRESET_SPEED:
         return MAX_PRESET_SPEED
-
+    elif value_type is float:
+        return value
     return float(value)
 
 
-def validate_envelope(envelope):
-    if not _is_object(envelope):
-        return False, ERROR_MALFORMED_FRAME, "Envelope must be an object."
-
-    required = {
-        "v": int,
-        "type": str,
-        "id": str,
-        "ts": (int, float),
-        "payload": dict,
-    }
+_ENVELOPE_REQUIRED = (
+    ("v", int),
+    ("type", str),
+    ("id", str),
+    ("ts", (int, float)),
+)
+_ENVELOPE_OK = (True, None, None)
+_ENVELOPE_NOT_OBJECT = (False, ERROR_MALFORMED_FRAME, "Envelope must be an object.")
+_ENVELOPE_UNSUPPORTED_VERSION = (
+    False,
+    ERROR_UNSUPPORTED_VERSION,
+    "Unsupported protocol version.",
+)
+_ENVELOPE_EMPTY_ID = (False, ERROR_MALFORMED_FRAME, "Envelope id must be a non-empty string.")
+_ENVELOPE_EMPTY_TYPE = (
+    False,
+    ERROR_MALFORMED_FRAME,
+    "Envelope type must be a non-empty string.",
+)
+
+
+# Distinguishes a missing envelope field from one present as null.
+_MISSING = object()
 
-    for key, expected_type in required.items():
-        if key not in envelope:
+
+def _envelope_field_error(envelope):
+    get = envelope.get
+    for key, expected_type in _ENVELOPE_REQUIRED:
+        value = get(key, _MISSING)
+        if value is _MISSING:
             return (
                 False,
                 ERROR_MALFORMED_FRAME,
                 "Missing required envelope field: %s" % key,
             )
 
-        value = envelope[key]
-        if key == "payload":
-            if not _is_object(value):
-                return False, ERROR_MALFORMED_FRAME, "Envelope payload must be an object."
-            continue
-
         if not isinstance(value, expected_type):
             return (
                 False,
@@ -197,75 +262,115 @@ def validate_envelope(envelope):
                 "Invalid envelope field type for: %s" % key,
             )
 
-    if envelope["v"] != PROTOCOL_VERSION:
-        return False, ERROR_UNSUPPORTED_VERSION, "Unsupported protocol version."
+    payload = get("payload", _MISSING)
+    if payload is _MISSING:
+        return False, ERROR_MALFORMED_FRAME, "Missing required envelope field: payload"
+    if not _is_object(payload):
+        return False, ERROR_MALFORMED_FRAME, "Envelope payload must be an object."
 
-    if not envelope["id"]:
-        return False, ERROR_MALFORMED_FRAME, "Envelope id must be a non-empty string."
+    return None
 
-    if not envelope["type"]:
-        return False, ERROR_MALFORMED_FRAME, "Envelope type must be a non-empty string."
 
-    return True, None, None
+def validate_envelope(envelope):
+    if not _is_object(envelope):
+        return _ENVELOPE_NOT_OBJECT
+
+    get = envelope.get
+    version = get("v")
+    message_type = get("type")
+    message_id = get("id")
+    ts = get("ts")
+    if not (
+        type(version) is int
+        and type(message_type) is str
+        and type(message_id) is str
+        and (type(ts) is int or type(ts) is float)
+        and type(get("payload")) is dict
+    ):
+        field_error = _envelope_field_error(envelope)
+        if field_error is not None:
+            return field_error
+
+    if version != PROTOCOL_VERSION:
+        return _ENVELOPE_UNSUPPORTED_VERSION
+
+    if not message_id:
+        return _ENVELOPE_EMPTY_ID
+
+    if not message_type:
+        return _ENVELOPE_EMPTY_TYPE
+
+    return _ENVELOPE_OK
+
+
+_MODIFIER_CHORD_CHECKS = tuple(
+    (
+        key,
+        (False, "state.modifierChords.%s must be a string." % key),
+        (False, "state.modifierChords.%s is unsupported." % key),
+    )
+    for key in REQUIRED_MODIFIER_KEYS
+)
+_MODIFIER_CHORDS_NOT_OBJECT = (False, "state.modifierChords must be an object.")
 
 
 def _validate_modifier_chords(modifier_chords):
     if not _is_object(modifier_chords):
-        return False, "state.modifierChords must be an object."
+        return _MODIFIER_CHORDS_NOT_OBJECT
 
-    for key in REQUIRED_MODIFIER_KEYS:
-        chord_name = modifier_chords.get(key)
-        if not isinstance(chord_name, str):
-            return False, "state.modifierChords.%s must be a string." % key
-        if chord_name not in ALLOWED_CHORD_TYPES:
-            return False, "state.modifierChords.%s is unsupported." % key
+    get = modifier_chords.get
+    for key, not_string_error, unsupported_error in _MODIFIER_CHORD_CHECKS:
+        chord_name = get(key)
+        if type(chord_name) is not str:
+            return not_string_error
+        if chord_name not in _ALLOWED_CHORD_TYPES:
+            return unsupported_error
 
     return True, None
 
 
+def _note_preset_section_spec(name, color_keys, has_speed):
+    prefix = "state.notePreset." + name
+    return (
+        name,
+        (False, prefix + " must be an object."),
+        tuple((key, (False, "%s.%s must be #RRGGBB." % (prefix, key))) for key in color_keys),
+        (
+            False,
+            "%s.speed must be between %.1f and %.1f."
+            % (prefix, MIN_PRESET_SPEED, MAX_PRESET_SPEED),
+        )
+        if has_speed
+        else None,
+    )
+
+
+_NOTE_PRESET_SECTIONS = (
+    _note_preset_section_spec("piano", ("whiteKeyColor", "blackKeyColor"), False),
+    _note_preset_section_spec("gradient", ("colorA", "colorB"), True),
+    _note_preset_section_spec("rain", ("colorA", "colorB"), True),
+)
+_NOTE_PRESET_NOT_OBJECT = (False, "state.notePreset must be an object.")
+_NOTE_PRESET_BAD_MODE = (False, "state.notePreset.mode is unsupported.")
+
+
 def _validate_note_preset(note_preset):
     if not _is_object(note_preset):
-        return False, "state.notePreset must be an object."
+        return _NOTE_PRESET_NOT_OBJECT
 
     mode = note_preset.get("mode")
-    if mode not in ALLOWED_NOTE_PRESET_MODES:
-        return False, "state.notePreset.mode is unsupported."
-
-    piano = note_preset.get("piano")
-    if not _is_object(piano):
-        return False, "state.notePreset.piano must be an object."
-    if not _is_hex_color(piano.get("whiteKeyColor")):
-        return False, "state.notePreset.piano.whiteKeyColor must be #RRGGBB."
-    if not _is_hex_color(piano.get("blackKeyColor")):
-        return False, "state.notePreset.piano.blackKeyColor must be #RRGGBB."
-
-    gradient = note_preset.get("gradient")
-    if not _is_object(gradient):
-        return False, "state.notePreset.gradient must be an object."
-    if not _is_hex_color(gradient.get("colorA")):
-        return False, "state.notePreset.gradient.colorA must be #RRGGBB."
-    if not _is_hex_color(gradient.get("colorB")):
-        return False, "state.notePreset.gradient.colorB must be #RRGGBB."
-    if not _is_valid_speed(gradient.get("speed")):
-        return (
-            False,
-            "state.notePreset.gradient.speed must be between %.1f and %.1f."
-            % (MIN_PRESET_SPEED, MAX_PRESET_SPEED),
-        )
-
-    rain = note_preset.get("rain")
-    if not _is_object(rain):
-        return False, "state.notePreset.rain must be an object."
-    if not _is_hex_color(rain.get("colorA")):
-        return False, "state.notePreset.rain.colorA must be #RRGGBB."
-    if not _is_hex_color(rain.get("colorB")):
-        return False, "state.notePreset.rain.colorB must be #RRGGBB."
-    if not _is_valid_speed(rain.get("speed")):
-        return (
-            False,
-            "state.notePreset.rain.speed must be between %.1f and %.1f."
-            % (MIN_PRESET_SPEED, MAX_PRESET_SPEED),
-        )
+    if not isinstance(mode, str) or mode not in _ALLOWED_NOTE_PRESET_MODES:
+        return _NOTE_PRESET_BAD_MODE
+
+    for name, not_object_error, color_checks, speed_error in _NOTE_PRESET_SECTIONS:
+        section = note_preset.get(name)
+        if not _is_object(section):
+            return not_object_error
+        for key, color_error in color_checks:
+            if not _is_hex_color(section.get(key)):
+                return color_error
+        if speed_error is not None and not _is_valid_speed(section.get("speed")):
+            return speed_error
 
     return True, None
 
@@ -274,91 +379,111 @@ def validate_device_state(candidate):
     if not _is_object(candidate):
         return False, "state must be an object."
 
-    if "notePreset" not in candidate and isinstance(candidate.get("showBlackKeys"), bool):
-        if "modifierChords" in candidate:
-            modifiers_valid, modifier_error = _validate_modifier_chords(
-                candidate.get("modifierChords")
-            )
+    note_preset = candidate.get("notePreset", _MISSING)
+    modifier_chords = candidate.get("modifierChords", _MISSING)
+    if note_preset is _MISSING and isinstance(candidate.get("showBlackKeys"), bool):
+        if modifier_chords is not _MISSING:
+            modifiers_valid, modifier_error = _validate_modifier_chords(modifier_chords)
             if not modifiers_valid:
                 return False, modifier_error
         return True, None
 
-    note_preset_valid, note_preset_error = _validate_note_preset(candidate.get("notePreset"))
+    note_preset_valid, note_preset_error = _validate_note_preset(note_preset)
     if not note_preset_valid:
         return False, note_preset_error
 
-    modifier_chords_valid, modifier_error = _validate_modifier_chords(
-        candidate.get("modifierChords")
-    )
+    modifier_chords_valid, modifier_error = _validate_modifier_chords(modifier_chords)
     if not modifier_chords_valid:
         return False, modifier_error
 
     return True, None
 
 
+def _is_canonical_note_colors(section, count):
+    if len(section) != count:
+        return False
+    for value in section.values():
+        if type(value) is str and value.rstrip(LOWER_HEX_DIGITS) != "#":
+            return False
+    return True
+
+
+def _is_canonical_device_state(candidate):
+    if len(candidate) != 2 or len(candidate["modifierChords"]) != 4:
+        return False
+
+    note_preset = candidate["notePreset"]
+    if len(note_preset) != 4:
+        return False
+
+    gradient = note_preset["gradient"]
+    rain = note_preset["rain"]
+    return (
+        type(gradient["speed"]) is float
+        and type(rain["speed"]) is float
+        and _is_canonical_note_colors(note_preset["piano"], 2)
+        and _is_canonical_note_colors(gradient, 3)
+        and _is_canonical_note_colors(rain, 3)
+    )
+
+
 def normalize_device_state_candidate(candidate):
     valid_state, _ = validate_device_state(candidate)
     if not valid_state:
         return None
 
-    defaults = default_device_state()
+    return _build_normalized_state(candidate)
+
+
+def _wire_device_state(candidate):
+    # Internal: a canonical state is returned as the caller's own object.
+    valid_state, _ = validate_device_state(candidate)
+    if not valid_state:
+        return None
+
+    if "notePreset" in candidate and _is_canonical_device_state(candidate):
+        return candidate
+
+    return _build_normalized_state(candidate)
+
 
-    if "notePreset" not in candidate and isinstance(candidate.get("showBlackKeys"), bool):
+def _build_normalized_state(candidate):
+    note_preset = candidate.get("notePreset", _MISSING)
+    if note_preset is _MISSING:
         migrated = default_device_state()
         if not candidate.get("showBlackKeys"):
-            migrated["notePreset"]["piano"]["blackKeyColor"] = migrated["notePreset"][
-                "piano"
-            ]["whiteKeyColor"]
+            migrated["notePreset"]["piano"]["blackKeyColor"] = _DEFAULT_PIANO["whiteKeyColor"]
 
-        if _is_object(candidate.get("modifierChords")):
+        modifier_chords = candidate.get("modifierChords")
+        if modifier_chords is not None:
             for key in REQUIRED_MODIFIER_KEYS:
-                chord_name = candidate["modifierChords"].get(key)
-                if isinstance(chord_name, str) and chord_name in ALLOWED_CHORD_TYPES:
-                    migrated["modifierChords"][key] = chord_name
+                migrated["modifierChords"][key] = modifier_chords[key]
 
         return migrated
 
-    note_preset = candidate["notePreset"]
+    piano = note_preset["piano"]
+    gradient = note_preset["gradient"]
+    rain = note_preset["rain"]
     return {
         "notePreset": {
             "mode": note_preset["mode"],
             "piano": {
                 "whiteKeyColor": _normalize_hex_color(
-                    note_preset["piano"]["whiteKeyColor"],
-                    defaults["notePreset"]["piano"]["whiteKeyColor"],
+                    piano["whiteKeyColor"], _DEFAULT_PIANO["whiteKeyColor"]
                 ),
                 "blackKeyColor": _normalize_hex_color(
-                    note_preset["piano"]["blackKeyColor"],
-                    defaults["notePreset"]["piano"]["blackKeyColor"],
+                    piano["blackKeyColor"], _DEFAULT_PIANO["blackKeyColor"]
                 ),
             },
             "gradient": {
-                "colorA": _normalize_hex_color(
-                    note_preset["gradient"]["colorA"],
-                    defaults["notePreset"]["gradient"]["colorA"],
-                ),
-                "colorB": _normalize_hex_color(
-                    note_preset["gradient"]["colorB"],
-                    defaults["notePreset"]["gradient"]["colorB"],
-                ),
-                "speed": _normalize_speed(
-                    note_preset["gradient"]["speed"],
-                    defaults["notePreset"]["gradient"]["speed"],
-                ),
+                "colorA": _normalize_hex_color(gradient["colorA"], _DEFAULT_GRADIENT["colorA"]),
+                "colorB": _normalize_hex_color(gradient["colorB"], _DEFAULT_GRADIENT["colorB"]),
+                "speed": _normalize_speed(gradient["speed"], _DEFAULT_GRADIENT["speed"]),
             },
             "rain": {
-                "colorA": _normalize_hex_color(
-                    note_preset["rain"]["colorA"],
-                    defaults["notePreset"]["rain"]["colorA"],
-                ),
-                "colorB": _normalize_hex_color(
-                    note_preset["rain"]["colorB"],
-                    defaults["notePreset"]["rain"]["colorB"],
-                ),
-                "speed": _normalize_speed(
-                    note_preset["rain"]["speed"],
-                    defaults["notePreset"]["rain"]["speed"],
-                ),
+                "colorA": _normalize_hex_color(rain["colorA"], _DEFAULT_RAIN["colorA"]),
+                "colorB": _normalize_hex_color(rain["colorB"], _DEFAULT_RAIN["colorB"]),
+                "speed": _normalize_speed(rain["speed"], _DEFAULT_RAIN["speed"]),
             },
         },
         "modifierChords": {
@@ -370,294 +495,206 @@ def normalize_device_state_candidate(candidate):
     }
 
 
+class PayloadError(Exception):
+    """A request payload failed validation; handlers turn it into a nack or error."""
+
+    def __init__(self, code, reason, retryable=False):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+        self.retryable = retryable
+
+
 def _validate_hello_payload(payload):
     if not _is_object(payload):
-        return False, ERROR_MALFORMED_FRAME, "hello payload must be an object."
+        raise PayloadError(ERROR_MALFORMED_FRAME, "hello payload must be an object.")
 
     client = payload.get("client")
     if not isinstance(client, str) or not client:
-        return False, ERROR_MALFORMED_FRAME, "hello payload.client must be a non-empty string."
+        raise PayloadError(
+            ERROR_MALFORMED_FRAME, "hello payload.client must be a non-empty string."
+        )
 
     requested_version = payload.get("requestedProtocolVersion")
     if not isinstance(requested_version, int):
-        return (
-            False,
+        raise PayloadError(
             ERROR_MALFORMED_FRAME,
             "hello payload.requestedProtocolVersion must be a number.",
         )
 
     if requested_version != PROTOCOL_VERSION:
-        return False, ERROR_UNSUPPORTED_VERSION, "Requested protocol version is unsupported."
-
-    return True, None, None
+        raise PayloadError(
+            ERROR_UNSUPPORTED_VERSION, "Requested protocol version is unsupported."
+        )
 
 
 def _validate_apply_config_payload(payload):
     if not _is_object(payload):
-        return (
-            False,
-            "invalid_config",
-            "apply_config payload must be an object.",
-            False,
-            None,
-        )
+        raise PayloadError("invalid_config", "apply_config payload must be an object.")
 
     config_id = payload.get("configId")
     if not isinstance(config_id, str) or not config_id:
-        return (
-            False,
-            "invalid_config",
-            "apply_config payload.configId must be a string.",
-            False,
-            None,
-        )
+        raise PayloadError("invalid_config", "apply_config payload.configId must be a string.")
 
     idempotency_key = payload.get("idempotencyKey")
     if not isinstance(idempotency_key, str) or not idempotency_key:
-        return (
-            False,
-            "invalid_config",
-            "apply_config payload.idempotencyKey must be a string.",
-            False,
-            None,
+        raise PayloadError(
+            "invalid_config", "apply_config payload.idempotencyKey must be a string."
         )
 
     normalized_state = normalize_device_state_candidate(payload.get("config"))
     if normalized_state is None:
-        return False, "invalid_config", "apply_config payload.config is invalid.", False, None
+        raise PayloadError("invalid_config", "apply_config payload.config is invalid.")
 
-    return True, None, None, False, normalized_state
+    return normalized_state
 
 
-def _validate_firmware_begin_payload(payload):
-    if not _is_object(payload):
-        return False, "invalid_firmware_update", "firmware_begin payload must be an object.", False, None
+def _is_nonempty_str(value):
+    return isinstance(value, str) and bool(value)
 
-    session_id = payload.get("sessionId")
-    if not isinstance(session_id, str) or not session_id:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_begin payload.sessionId must be a string.",
-            False,
-            None,
-        )
 
-    target_version = payload.get("targetVersion")
-    if not isinstance(target_version, str) or not target_version:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_begin payload.targetVersion must be a string.",
-            False,
-            None,
-        )
+def _is_safe_path(value):
+    return isinstance(value, str) and value.startswith("/") and ".." not in value
 
-    files = payload.get("files")
-    if not isinstance(files, list) or len(files) == 0:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_begin payload.files must be a non-empty array.",
-            False,
-            None,
-        )
 
-    normalized_files = []
-    for file_entry in files:
-        if not _is_object(file_entry):
-            return False, "invalid_firmware_update", "firmware_begin file entry must be an object.", False, None
+def _is_nonnegative_number(value):
+    value_type = type(value)
+    return (value_type is int or value_type is float) and value >= 0
 
-        path = file_entry.get("path")
-        if not isinstance(path, str) or not path.startswith("/") or ".." in path:
-            return False, "invalid_firmware_update", "firmware_begin file path is invalid.", False, None
 
-        size = file_entry.get("size")
-        if not isinstance(size, (int, float)) or size < 0:
-            return False, "invalid_firmware_update", "firmware_begin file size is invalid.", False, None
+def _is_nonnegative_int(value):
+    return type(value) is int and value >= 0
 
-        sha256 = file_entry.get("sha256")
-        if not _is_hex_digest_64(sha256):
-            return False, "invalid_firmware_update", "firmware_begin file sha256 is invalid.", False, None
 
-        normalized_files.append(
-            {
-                "path": path,
-                "size": int(size),
-                "sha256": sha256.lower(),
-            }
-        )
+def _is_optional_str(value):
+    return value is None or isinstance(value, str)
 
-    return (
-        True,
-        None,
-        None,
-        False,
-        {
-            "sessionId": session_id,
-            "targetVersion": target_version,
-            "files": normalized_files,
-        },
-    )
 
+def _lower(value):
+    return value.lower()
 
-def _validate_firmware_chunk_payload(payload):
-    if not _is_object(payload):
-        return False, "invalid_firmware_update", "firmware_chunk payload must be an object.", False, None
 
-    session_id = payload.get("sessionId")
-    if not isinstance(session_id, str) or not session_id:
-        return False, "invalid_firmware_update", "firmware_chunk payload.sessionId must be a string.", False, None
+_FIRMWARE_FIELD_SPECS = {
+    "sessionId": (_is_nonempty_str, None, "must be a string."),
+    "targetVersion": (_is_nonempty_str, None, "must be a string."),
+    "path": (_is_safe_path, None, "is invalid."),
+    "size": (_is_nonnegative_number, int, "is invalid."),
+    "sha256": (_is_hex_digest_64, _lower, "is invalid."),
+    "chunkIndex": (_is_nonnegative_int, None, "is invalid."),
+    "dataBase64": (_is_nonempty_str, None, "is invalid."),
+    "reason": (_is_optional_str, None, "must be a string."),
+}
+
+_FIRMWARE_BEGIN_FIELDS = ("sessionId", "targetVersion")
+_FIRMWARE_BEGIN_FILE_FIELDS = ("path", "size", "sha256")
+_FIRMWARE_CHUNK_FIELDS = ("sessionId", "path", "chunkIndex", "dataBase64")
+_FIRMWARE_FILE_COMPLETE_FIELDS = ("sessionId", "path", "size", "sha256")
+_FIRMWARE_COMMIT_FIELDS = ("sessionId", "targetVersion")
+_FIRMWARE_ABORT_FIELDS = ("sessionId", "reason")
+
+
+def _firmware_payload_messages(request_type, field_names):
+    messages = {"": "%s payload must be an object." % request_type}
+    for name in field_names:
+        messages[name] = "%s payload.%s %s" % (
+            request_type,
+            name,
+            _FIRMWARE_FIELD_SPECS[name][2],
+        )
+    return messages
 
-    path = payload.get("path")
-    if not isinstance(path, str) or not path.startswith("/") or ".." in path:
-        return False, "invalid_firmware_update", "firmware_chunk payload.path is invalid.", False, None
 
-    chunk_index = payload.get("chunkIndex")
-    if not isinstance(chunk_index, int) or chunk_index < 0:
-        return False, "invalid_firmware_update", "firmware_chunk payload.chunkIndex is invalid.", False, None
+_FIRMWARE_BEGIN_MESSAGES = _firmware_payload_messages("firmware_begin", _FIRMWARE_BEGIN_FIELDS)
+_FIRMWARE_BEGIN_FILE_MESSAGES = {
+    name: "firmware_begin file %s is invalid." % name for name in _FIRMWARE_BEGIN_FILE_FIELDS
+}
+_FIRMWARE_CHUNK_MESSAGES = _firmware_payload_messages("firmware_chunk", _FIRMWARE_CHUNK_FIELDS)
+_FIRMWARE_FILE_COMPLETE_MESSAGES = _firmware_payload_messages(
+    "firmware_file_complete", _FIRMWARE_FILE_COMPLETE_FIELDS
+)
+_FIRMWARE_COMMIT_MESSAGES = _firmware_payload_messages("firmware_commit", _FIRMWARE_COMMIT_FIELDS)
+_FIRMWARE_ABORT_MESSAGES = _firmware_payload_messages("firmware_abort", _FIRMWARE_ABORT_FIELDS)
 
-    data_base64 = payload.get("dataBase64")
-    if not isinstance(data_base64, str) or not data_base64:
-        return False, "invalid_firmware_update", "firmware_chunk payload.dataBase64 is invalid.", False, None
 
-    return (
-        True,
-        None,
-        None,
-        False,
-        {
-            "sessionId": session_id,
-            "path": path,
-            "chunkIndex": chunk_index,
-            "dataBase64": data_base64,
-        },
-    )
+def _firmware_payload_error(message):
+    return PayloadError("invalid_firmware_update", message)
 
 
-def _validate_firmware_file_complete_payload(payload):
-    if not _is_object(payload):
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_file_complete payload must be an object.",
-            False,
-            None,
-        )
+def _normalize_firmware_fields(source, field_names, messages):
+    normalized = {}
+    for name in field_names:
+        check, normalize, _ = _FIRMWARE_FIELD_SPECS[name]
+        value = source.get(name)
+        if not check(value):
+            raise _firmware_payload_error(messages[name])
+        normalized[name] = value if normalize is None else normalize(value)
+    return normalized
 
-    session_id = payload.get("sessionId")
-    if not isinstance(session_id, str) or not session_id:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_file_complete payload.sessionId must be a string.",
-            False,
-            None,
-        )
 
-    path = payload.get("path")
-    if not isinstance(path, str) or not path.startswith("/") or ".." in path:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_file_complete payload.path is invalid.",
-            False,
-            None,
-        )
+def _validate_firmware_fields(payload, field_names, messages):
+    if not _is_object(payload):
+        raise _firmware_payload_error(messages[""])
 
-    size = payload.get("size")
-    if not isinstance(size, (int, float)) or size < 0:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_file_complete payload.size is invalid.",
-            False,
-            None,
-        )
+    return _normalize_firmware_fields(payload, field_names, messages)
 
-    sha256 = payload.get("sha256")
-    if not _is_hex_digest_64(sha256):
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_file_complete payload.sha256 is invalid.",
-            False,
-            None,
-        )
 
-    return (
-        True,
-        None,
-        None,
-        False,
-        {
-            "sessionId": session_id,
-            "path": path,
-            "size": int(size),
-            "sha256": sha256.lower(),
-        },
+def _validate_firmware_begin_payload(payload):
+    normalized = _validate_firmware_fields(
+        payload, _FIRMWARE_BEGIN_FIELDS, _FIRMWARE_BEGIN_MESSAGES
     )
 
+    files = payload.get("files")
+    if not isinstance(files, list) or len(files) == 0:
+        raise _firmware_payload_error("firmware_begin payload.files must be a non-empty array.")
 
-def _validate_firmware_commit_payload(payload):
-    if not _is_object(payload):
-        return False, "invalid_firmware_update", "firmware_commit payload must be an object.", False, None
-
-    session_id = payload.get("sessionId")
-    if not isinstance(session_id, str) or not session_id:
-        return False, "invalid_firmware_update", "firmware_commit payload.sessionId must be a string.", False, None
+    normalized_files = []
+    for file_entry in files:
+        if not _is_object(file_entry):
+            raise _firmware_payload_error("firmware_begin file entry must be an object.")
 
-    target_version = payload.get("targetVersion")
-    if not isinstance(target_version, str) or not target_version:
-        return (
-            False,
-            "invalid_firmware_update",
-            "firmware_commit payload.targetVersion must be a string.",
-            False,
-            None,
+        normalized_files.append(
+            _normalize_firmware_fields(
+                file_entry, _FIRMWARE_BEGIN_FILE_FIELDS, _FIRMWARE_BEGIN_FILE_MESSAGES
+            )
         )
 
-    return (
-        True,
-        None,
-        None,
-        False,
-        {
-            "sessionId": session_id,
-            "targetVersion": target_version,
-        },
+    normalized["files"] = normalized_files
+    return normalized
+
+
+def _validate_firmware_chunk_payload(payload):
+    return _validate_firmware_fields(payload, _FIRMWARE_CHUNK_FIELDS, _FIRMWARE_CHUNK_MESSAGES)
+
+
+def _validate_firmware_file_complete_payload(payload):
+    return _validate_firmware_fields(
+        payload, _FIRMWARE_FILE_COMPLETE_FIELDS, _FIRMWARE_FILE_COMPLETE_MESSAGES
     )
 
 
-def _validate_firmware_abort_payload(payload):
-    if not _is_object(payload):
-        return False, "invalid_firmware_update", "firmware_abort payload must be an object.", False, None
+def _validate_firmware_commit_payload(payload):
+    return _validate_firmware_fields(payload, _FIRMWARE_COMMIT_FIELDS, _FIRMWARE_COMMIT_MESSAGES)
 
-    session_id = payload.get("sessionId")
-    if not isinstance(session_id, str) or not session_id:
-        return False, "invalid_firmware_update", "firmware_abort payload.sessionId must be a string.", False, None
 
-    reason = payload.get("reason")
-    if reason is not None and not isinstance(reason, str):
-        return False, "invalid_firmware_update", "firmware_abort payload.reason must be a string.", False, None
+def _validate_firmware_abort_payload(payload):
+    return _validate_firmware_fields(payload, _FIRMWARE_ABORT_FIELDS, _FIRMWARE_ABORT_MESSAGES)
 
-    return (
-        True,
-        None,
-        None,
-        False,
-        {
-            "sessionId": session_id,
-            "reason": reason,
-        },
-    )
+
+_wrapped_capabilities = None
+_wrapped_context = None
 
 
 def _normalize_context(context_or_capabilities):
+    global _wrapped_capabilities, _wrapped_context
+
     if _is_object(context_or_capabilities) and "capabilities" in context_or_capabilities:
         return context_or_capabilities
 
-    return {
+    if _wrapped_context is not None and context_or_capabilities is _wrapped_capabilities:
+        return _wrapped_context
+
+    _wrapped_capabilities = context_or_capabilities
+    _wrapped_context = {
         "capabilities": context_or_capabilities,
         "get_state": None,
         "apply_config": None,
@@ -668,400 +705,292 @@ def _normalize_context(context_or_capabilities):
         "firmware_abort": None,
         "on_handshake": None,
     }
+    return _wrapped_context
 
 
 def _call_get_state(context):
     getter = context.get("get_state")
     if callable(getter):
         state = getter()
-        normalized_state = normalize_device_state_candidate(state)
+        normalized_state = _wire_device_state(state)
         if normalized_state is not None:
             return normalized_state
 
     capabilities = context.get("capabilities")
     if _is_object(capabilities):
         state = capabilities.get("state")
-        normalized_state = normalize_device_state_candidate(state)
+        normalized_state = _wire_device_state(state)
         if normalized_state is not None:
             return normalized_state
 
     return default_device_state()
 
 
-def _call_apply_config(context, config, config_id, idempotency_key):
-    applier = context.get("apply_config")
-    if not callable(applier):
-        return {
-            "ok": False,
-            "code": "unsupported_operation",
-            "reason": "apply_config is not supported by this endpoint.",
-            "retryable": False,
-        }
+def _unsupported_operation_nack(message_id, request_type, ts_ms):
+    return make_nack(
+        message_id,
+        request_type,
+        "unsupported_operation",
+        request_type + " is not supported by this endpoint.",
+        False,
+        ts_ms,
+    )
 
-    return applier(config, config_id, idempotency_key)
 
+def _emit_handshake_event(context):
+    callback = context.get("on_handshake")
+    if callable(callback):
+        try:
+            callback()
+        except Exception:
+            pass
 
-def _call_firmware_begin(context, session_id, target_version, files):
-    updater = context.get("firmware_begin")
-    if not callable(updater):
-        return {
-            "ok": False,
-            "code": "unsupported_operation",
-            "reason": "firmware_begin is not supported by this endpoint.",
-            "retryable": False,
-        }
 
-    return updater(session_id, target_version, files)
+def _payload_error_nack(message_id, request_type, error, ts_ms):
+    return make_nack(message_id, request_type, error.code, error.reason, error.retryable, ts_ms)
 
 
-def _call_firmware_chunk(context, session_id, path, chunk_index, data_base64):
-    updater = context.get("firmware_chunk")
-    if not callable(updater):
-        return {
-            "ok": False,
-            "code": "unsupported_operation",
-            "reason": "firmware_chunk is not supported by this endpoint.",
-            "retryable": False,
-        }
+def _handle_hello(message_id, payload, context, ts_ms):
+    try:
+        _validate_hello_payload(payload)
+    except PayloadError as error:
+        return make_error(message_id, error.code, error.reason, {"type": "hello"}, ts_ms)
 
-    return updater(session_id, path, chunk_index, data_base64)
+    state = _call_get_state(context)
 
+    _emit_handshake_event(context)
 
-def _call_firmware_file_complete(context, session_id, path, size, sha256):
-    updater = context.get("firmware_file_complete")
-    if not callable(updater):
-        return {
-            "ok": False,
-            "code": "unsupported_operation",
-            "reason": "firmware_file_complete is not supported by this endpoint.",
-            "retryable": False,
-        }
+    capabilities = context.get("capabilities")
+    hello_payload = dict(capabilities) if _is_object(capabilities) else {}
+    hello_payload["state"] = state
+    return make_envelope("hello_ack", message_id, hello_payload, ts_ms)
 
-    return updater(session_id, path, size, sha256)
 
+def _handle_get_state(message_id, payload, context, ts_ms):
+    return make_ack(message_id, "get_state", ts_ms, {"state": _call_get_state(context)})
 
-def _call_firmware_commit(context, session_id, target_version):
-    updater = context.get("firmware_commit")
-    if not callable(updater):
-        return {
-            "ok": False,
-            "code": "unsupported_operation",
-            "reason": "firmware_commit is not supported by this endpoint.",
-            "retryable": False,
-        }
 
-    return updater(session_id, target_version)
+def _handle_apply_config(message_id, payload, context, ts_ms):
+    applier = context.get("apply_config")
+    if not callable(applier):
+        return _unsupported_operation_nack(message_id, "apply_config", ts_ms)
 
+    try:
+        normalized_config = _validate_apply_config_payload(payload)
+    except PayloadError as error:
+        return _payload_error_nack(message_id, "apply_config", error, ts_ms)
 
-def _call_firmware_abort(context, session_id, reason):
-    updater = context.get("firmware_abort")
-    if not callable(updater):
-        return {
-            "ok": False,
-            "code": "unsupported_operation",
-            "reason": "firmware_abort is not supported by this endpoint.",
-            "retryable": False,
-        }
+    config_id = payload["configId"]
+    idempotency_key = payload["idempotencyKey"]
 
-    return updater(session_id, reason)
+    apply_result = applier(normalized_config, config_id, idempotency_key)
+    if not _is_object(apply_result):
+        return make_nack(
+            message_id,
+            "apply_config",
+            "internal_error",
+            "apply_config result is invalid.",
+            True,
+            ts_ms,
+        )
 
+    if not apply_result.get("ok"):
+        return make_nack(
+            message_id,
+            "apply_config",
+            apply_result.get("code", "internal_error"),
+            apply_result.get("reason", "Unable to apply config."),
+            bool(apply_result.get("retryable", False)),
+            ts_ms,
+        )
 
-def _emit_handshake_event(context):
-    callback = context.get("on_handshake")
-    if callable(callback):
-        try:
-            callback()
-        except Exception:
-            pass
+    state = _wire_device_state(apply_result.get("state"))
+    if state is None:
+        return make_nack(
+            message_id,
+            "apply_config",
+            "internal_state_invalid",
+            "apply_config returned an invalid state.",
+            False,
+            ts_ms,
+        )
 
+    return make_ack(
+        message_id,
+        "apply_config",
+        ts_ms,
+        {
+            "state": state,
+            "appliedConfigId": apply_result.get("appliedConfigId", config_id),
+        },
+    )
 
-def dispatch_message(envelope, context, ts_ms):
-    message_id = envelope["id"]
-    message_type = envelope["type"]
-    payload = envelope["payload"]
-    capabilities = context.get("capabilities")
 
-    if message_type == "hello":
-        valid_payload, payload_error_code, payload_error_message = _validate_hello_payload(
-            payload
-        )
-        if not valid_payload:
-            return make_error(
-                message_id,
-                payload_error_code,
-                payload_error_message,
-                {"type": message_type},
-                ts_ms,
-            )
+def _handle_ping(message_id, payload, context, ts_ms):
+    return make_ack(message_id, "ping", ts_ms, {"pongTs": ts_ms})
 
-        state = _call_get_state(context)
-        valid_state, state_error = validate_device_state(state)
-        if not valid_state:
-            return make_error(
-                message_id,
-                "internal_error",
-                "Device state is invalid.",
-                {"reason": state_error},
-                ts_ms,
-            )
 
-        _emit_handshake_event(context)
-
-        hello_payload = dict(capabilities) if _is_object(capabilities) else {}
-        hello_payload["state"] = normalize_device_state_candidate(state)
-        return make_envelope("hello_ack", message_id, hello_payload, ts_ms)
-
-    if message_type == "get_state":
-        state = _call_get_state(context)
-        normalized_state = normalize_device_state_candidate(state)
-        if normalized_state is None:
-            return make_nack(
-                message_id,
-                "get_state",
-                "internal_state_invalid",
-                "Device state is invalid.",
-                False,
-                ts_ms,
-            )
+def _firmware_result_frame(message_id, request_type, result, failure_reason, ts_ms):
+    if not _is_object(result):
+        return make_nack(
+            message_id,
+            request_type,
+            "internal_error",
+            request_type + " result is invalid.",
+            True,
+            ts_ms,
+        )
+    if not result.get("ok"):
+        return make_nack(
+            message_id,
+            request_type,
+            result.get("code", "internal_error"),
+            result.get("reason", failure_reason),
+            bool(result.get("retryable", False)),
+            ts_ms,
+        )
 
-        return make_ack(message_id, "get_state", ts_ms, {"state": normalized_state})
+    extra_payload = result.get("payload") if _is_object(result.get("payload")) else None
+    return make_ack(message_id, request_type, ts_ms, extra_payload)
 
-    if message_type == "apply_config":
-        payload_ok, code, reason, retryable, normalized_config = _validate_apply_config_payload(
-            payload
-        )
-        if not payload_ok:
-            return make_nack(message_id, "apply_config", code, reason, retryable, ts_ms)
 
-        config_id = payload["configId"]
-        idempotency_key = payload["idempotencyKey"]
+def _handle_firmware_begin(message_id, payload, context, ts_ms):
+    updater = context.get("firmware_begin")
+    if not callable(updater):
+        return _unsupported_operation_nack(message_id, "firmware_begin", ts_ms)
 
-        apply_result = _call_apply_config(
-            context, normalized_config, config_id, idempotency_key
-        )
-        if not _is_object(apply_result):
-            return make_nack(
-                message_id,
-                "apply_config",
-                "internal_error",
-                "apply_config result is invalid.",
-                True,
-                ts_ms,
-            )
+    try:
+        normalized_payload = _validate_firmware_begin_payload(payload)
+    except PayloadError as error:
+        return _payload_error_nack(message_id, "firmware_begin", error, ts_ms)
+
+    result = updater(
+        normalized_payload["sessionId"],
+        normalized_payload["targetVersion"],
+        normalized_payload["files"],
+    )
+    return _firmware_result_frame(
+        message_id, "firmware_begin", result, "Unable to begin firmware update.", ts_ms
+    )
 
-        if not apply_result.get("ok"):
-            return make_nack(
-                message_id,
-                "apply_config",
-                apply_result.get("code", "internal_error"),
-                apply_result.get("reason", "Unable to apply config."),
-                bool(apply_result.get("retryable", False)),
-                ts_ms,
-            )
 
-        state = normalize_device_state_candidate(apply_result.get("state"))
-        if state is None:
-            return make_nack(
-                message_id,
-                "apply_config",
-                "internal_state_invalid",
-                "apply_config returned an invalid state.",
-                False,
-                ts_ms,
-            )
+def _handle_firmware_chunk(message_id, payload, context, ts_ms):
+    updater = context.get("firmware_chunk")
+    if not callable(updater):
+        return _unsupported_operation_nack(message_id, "firmware_chunk", ts_ms)
 
-        return make_ack(
-            message_id,
-            "apply_config",
-            ts_ms,
-            {
-                "state": state,
-                "appliedConfigId": apply_result.get("appliedConfigId", config_id),
-            },
-        )
+    try:
+        normalized_payload = _validate_firmware_chunk_payload(payload)
+    except PayloadError as error:
+        return _payload_error_nack(message_id, "firmware_chunk", error, ts_ms)
+
+    result = updater(
+        normalized_payload["sessionId"],
+        normalized_payload["path"],
+        normalized_payload["chunkIndex"],
+        normalized_payload["dataBase64"],
+    )
+    return _firmware_result_frame(
+        message_id, "firmware_chunk", result, "Unable to apply firmware chunk.", ts_ms
+    )
 
-    if message_type == "ping":
-        return make_ack(message_id, "ping", ts_ms, {"pongTs": ts_ms})
 
-    if message_type == "firmware_begin":
-        payload_ok, code, reason, retryable, normalized_payload = _validate_firmware_begin_payload(payload)
-        if not payload_ok:
-            return make_nack(message_id, "firmware_begin", code, reason, retryable, ts_ms)
+def _handle_firmware_file_complete(message_id, payload, context, ts_ms):
+    updater = context.get("firmware_file_complete")
+    if not callable(updater):
+        return _unsupported_operation_nack(message_id, "firmware_file_complete", ts_ms)
 
-        result = _call_firmware_begin(
-            context,
-            normalized_payload["sessionId"],
-            normalized_payload["targetVersion"],
-            normalized_payload["files"],
-        )
-        if not _is_object(result):
-            return make_nack(
-                message_id,
-                "firmware_begin",
-                "internal_error",
-                "firmware_begin result is invalid.",
-                True,
-                ts_ms,
-            )
-        if not result.get("ok"):
-            return make_nack(
-                message_id,
-                "firmware_begin",
-                result.get("code", "internal_error"),
-                result.get("reason", "Unable to begin firmware update."),
-                bool(result.get("retryable", False)),
-                ts_ms,
-            )
+    try:
+        normalized_payload = _validate_firmware_file_complete_payload(payload)
+    except PayloadError as error:
+        return _payload_error_nack(message_id, "firmware_file_complete", error, ts_ms)
+
+    result = updater(
+        normalized_payload["sessionId"],
+        normalized_payload["path"],
+        normalized_payload["size"],
+        normalized_payload["sha256"],
+    )
+    return _firmware_result_frame(
+        message_id,
+        "firmware_file_complete",
+        result,
+        "Unable to complete firmware file.",
+        ts_ms,
+    )
 
-        extra_payload = result.get("payload") if _is_object(result.get("payload")) else None
-        return make_ack(message_id, "firmware_begin", ts_ms, extra_payload)
 
-    if message_type == "firmware_chunk":
-        payload_ok, code, reason, retryable, normalized_payload = _validate_firmware_chunk_payload(payload)
-        if not payload_ok:
-            return make_nack(message_id, "firmware_chunk", code, reason, retryable, ts_ms)
+def _handle_firmware_commit(message_id, payload, context, ts_ms):
+    updater = context.get("firmware_commit")
+    if not callable(updater):
+        return _unsupported_operation_nack(message_id, "firmware_commit", ts_ms)
 
-        result = _call_firmware_chunk(
-            context,
-            normalized_payload["sessionId"],
-            normalized_payload["path"],
-            normalized_payload["chunkIndex"],
-            normalized_payload["dataBase64"],
-        )
-        if not _is_object(result):
-            return make_nack(
-                message_id,
-                "firmware_chunk",
-                "internal_error",
-                "firmware_chunk result is invalid.",
-                True,
-                ts_ms,
-            )
-        if not result.get("ok"):
-            return make_nack(
-                message_id,
-                "firmware_chunk",
-                result.get("code", "internal_error"),
-                result.get("reason", "Unable to apply firmware chunk."),
-                bool(result.get("retryable", False)),
-                ts_ms,
-            )
+    try:
+        normalized_payload = _validate_firmware_commit_payload(payload)
+    except PayloadError as error:
+        return _payload_error_nack(message_id, "firmware_commit", error, ts_ms)
 
-        extra_payload = result.get("payload") if _is_object(result.get("payload")) else None
-        return make_ack(message_id, "firmware_chunk", ts_ms, extra_payload)
+    result = updater(normalized_payload["sessionId"], normalized_payload["targetVersion"])
+    return _firmware_result_frame(
+        message_id, "firmware_commit", result, "Unable to commit firmware update.", ts_ms
+    )
 
-    if message_type == "firmware_file_complete":
-        payload_ok, code, reason, retryable, normalized_payload = _validate_firmware_file_complete_payload(
-            payload
-        )
-        if not payload_ok:
-            return make_nack(message_id, "firmware_file_complete", code, reason, retryable, ts_ms)
-
-        result = _call_firmware_file_complete(
-            context,
-            normalized_payload["sessionId"],
-            normalized_payload["path"],
-            normalized_payload["size"],
-            normalized_payload["sha256"],
-        )
-        if not _is_object(result):
-            return make_nack(
-                message_id,
-                "firmware_file_complete",
-                "internal_error",
-                "firmware_file_complete result is invalid.",
-                True,
-                ts_ms,
-            )
-        if not result.get("ok"):
-            return make_nack(
-                message_id,
-                "firmware_file_complete",
-                result.get("code", "internal_error"),
-                result.get("reason", "Unable to complete firmware file."),
-                bool(result.get("retryable", False)),
-                ts_ms,
-            )
 
-        extra_payload = result.get("payload") if _is_object(result.get("payload")) else None
-        return make_ack(message_id, "firmware_file_complete", ts_ms, extra_payload)
+def _handle_firmware_abort(message_id, payload, context, ts_ms):
+    updater = context.get("firmware_abort")
+    if not callable(updater):
+        return _unsupported_operation_nack(message_id, "firmware_abort", ts_ms)
 
-    if message_type == "firmware_commit":
-        payload_ok, code, reason, retryable, normalized_payload = _validate_firmware_commit_payload(payload)
-        if not payload_ok:
-            return make_nack(message_id, "firmware_commit", code, reason, retryable, ts_ms)
+    try:
+        normalized_payload = _validate_firmware_abort_payload(payload)
+    except PayloadError as error:
+        return _payload_error_nack(message_id, "firmware_abort", error, ts_ms)
+
+    result = updater(normalized_payload["sessionId"], normalized_payload["reason"])
+    return _firmware_result_frame(
+        message_id, "firmware_abort", result, "Unable to abort firmware update.", ts_ms
+    )
 
-        result = _call_firmware_commit(
-            context,
-            normalized_payload["sessionId"],
-            normalized_payload["targetVersion"],
-        )
-        if not _is_object(result):
-            return make_nack(
-                message_id,
-                "firmware_commit",
-                "internal_error",
-                "firmware_commit result is invalid.",
-                True,
-                ts_ms,
-            )
-        if not result.get("ok"):
-            return make_nack(
-                message_id,
-                "firmware_commit",
-                result.get("code", "internal_error"),
-                result.get("reason", "Unable to commit firmware update."),
-                bool(result.get("retryable", False)),
-                ts_ms,
-            )
 
-        extra_payload = result.get("payload") if _is_object(result.get("payload")) else None
-        return make_ack(message_id, "firmware_commit", ts_ms, extra_payload)
+_DISPATCH = {
+    "hello": _handle_hello,
+    "get_state": _handle_get_state,
+    "apply_config": _handle_apply_config,
+    "ping": _handle_ping,
+    "firmware_begin": _handle_firmware_begin,
+    "firmware_chunk": _handle_firmware_chunk,
+    "firmware_file_complete": _handle_firmware_file_complete,
+    "firmware_commit": _handle_firmware_commit,
+    "firmware_abort": _handle_firmware_abort,
+}
 
-    if message_type == "firmware_abort":
-        payload_ok, code, reason, retryable, normalized_payload = _validate_firmware_abort_payload(payload)
-        if not payload_ok:
-            return make_nack(message_id, "firmware_abort", code, reason, retryable, ts_ms)
 
-        result = _call_firmware_abort(
-            context,
-            normalized_payload["sessionId"],
-            normalized_payload["reason"],
+def dispatch_message(envelope, context, ts_ms):
+    message_id = envelope["id"]
+    message_type = envelope["type"]
+    handler = _DISPATCH.get(message_type)
+    if handler is None:
+        return make_error(
+            message_id,
+            ERROR_UNSUPPORTED_TYPE,
+            "Unsupported message type.",
+            {"type": message_type},
+            ts_ms,
         )
-        if not _is_object(result):
-            return make_nack(
-                message_id,
-                "firmware_abort",
-                "internal_error",
-                "firmware_abort result is invalid.",
-                True,
-                ts_ms,
-            )
-        if not result.get("ok"):
-            return make_nack(
-                message_id,
-                "firmware_abort",
-                result.get("code", "internal_error"),
-                result.get("reason", "Unable to abort firmware update."),
-                bool(result.get("retryable", False)),
-                ts_ms,
-            )
 
-        extra_payload = result.get("payload") if _is_object(result.get("payload")) else None
-        return make_ack(message_id, "firmware_abort", ts_ms, extra_payload)
+    return handler(message_id, envelope["payload"], context, ts_ms)
 
-    return make_error(
-        message_id,
-        ERROR_UNSUPPORTED_TYPE,
-        "Unsupported message type.",
-        {"type": message_type},
-        ts_ms,
-    )
+
+def _decode_json_line(line_text):
+    stripped = line_text.lstrip()
+    if len(stripped) == 0 or stripped[0] not in JSON_VALUE_START_CHARS:
+        raise ValueError("Line does not start a JSON value.")
+    return json.loads(line_text)
 
 
 def process_line(line_text, context_or_capabilities, ts_ms):
     try:
-        envelope = json.loads(line_text)
+        envelope = _decode_json_line(line_text)
     except ValueError:
         return make_error(
             UNMATCHED_ID,
@@ -1089,85 +1018,77 @@ def process_line(line_text, context_or_capabilities, ts_ms):
         )
 
 
-def process_serial_chunk(buffer, chunk, context_or_capabilities, ts_ms):
-    if chunk:
-        buffer.extend(chunk)
+def process_serial_chunk(
+    buffer, chunk, context_or_capabilities, ts_ms, chunk_length=None, out=None
+):
+    # Only the first chunk_length bytes of chunk are read. With `out` (a
+    # bytearray), encoded frames are appended to it and it is returned.
+    if chunk_length is None:
+        chunk_length = len(chunk) if chunk else 0
 
-    responses = []
+    if len(buffer) == 0 and chunk_length:
+        data = chunk
+        end = chunk_length
+    else:
+        if chunk_length:
+            buffer.extend(chunk if chunk_length == len(chunk) else memoryview(chunk)[:chunk_length])
+        data = buffer
+        end = len(buffer)
+
+    responses = [] if out is None else None
+    start = 0
 
     while True:
-        newline_index = buffer.find(b"\n")
+        newline_index = data.find(b"\n", start, end)
         if newline_index < 0:
             break
 
-        line_bytes = bytes(buffer[:newline_index])
-        buffer[:] = buffer[newline_index + 1 :]
-
-        if line_bytes.endswith(b"\r"):
-            line_bytes = line_bytes[:-1]
-
-        if len(line_bytes) == 0:
-            responses.append(
-                encode_frame(
-                    make_error(
-                        UNMATCHED_ID,
-                        ERROR_MALFORMED_FRAME,
-                        "Frame is empty.",
-                        None,
-                        ts_ms,
-                    )
-                )
-            )
+        line_start = start
+        line_end = newline_index
+        start = newline_index + 1
+        if line_end > line_start and data[line_end - 1] == 0x0D:
+            line_end -= 1
+        line_length = line_end - line_start
+
+        if line_length == 0:
+            _emit_static_error(_EMPTY_FRAME_ERROR, ts_ms, responses, out)
             continue
 
-        if len(line_bytes) > MAX_FRAME_SIZE:
-            responses.append(
-                encode_frame(
-                    make_error(
-                        UNMATCHED_ID,
-                        ERROR_MALFORMED_FRAME,
-                        "Frame exceeds maximum size.",
-                        {
-                            "maxFrameSize": MAX_FRAME_SIZE,
-                            "actualSize": len(line_bytes),
-                        },
-                        ts_ms,
-                    )
-                )
+        if line_length > MAX_FRAME_SIZE:
+            _emit_frame(
+                make_error(
+                    UNMATCHED_ID,
+                    ERROR_MALFORMED_FRAME,
+                    "Frame exceeds maximum size.",
+                    {
+                        "maxFrameSize": MAX_FRAME_SIZE,
+                        "actualSize": line_length,
+                    },
+                    ts_ms,
+                ),
+                responses,
+                out,
             )
             continue
 
         try:
-            line_text = line_bytes.decode("utf-8")
+            line_text = bytes(memoryview(data)[line_start:line_end]).decode("utf-8")
         except UnicodeError:
-            responses.append(
-                encode_frame(
-                    make_error(
-                        UNMATCHED_ID,
-                        ERROR_MALFORMED_FRAME,
-                        "Frame is not valid UTF-8.",
-                        None,
-                        ts_ms,
-                    )
-                )
-            )
+            _emit_static_error(_NON_UTF8_FRAME_ERROR, ts_ms, responses, out)
             continue
 
         response = process_line(line_text, context_or_capabilities, ts_ms)
-        responses.append(encode_frame(response))
+        _emit_frame(response, responses, out)
+
+    if data is not buffer:
+        if start < end:
+            buffer.extend(memoryview(data)[start:end])
+    elif start:
+        # CircuitPython's bytearray has no slice deletion.
+        buffer[:] = buffer[start:]
 
     if len(buffer) > MAX_FRAME_SIZE:
-        responses.append(
-            encode_frame(
-                make_error(
-                    UNMATCHED_ID,
-                    ERROR_MALFORMED_FRAME,
-                    "Missing newline terminator before max frame size.",
-                    {"maxFrameSize": MAX_FRAME_SIZE},
-                    ts_ms,
-                )
-            )
-        )
+        _emit_static_error(_UNTERMINATED_FRAME_ERROR, ts_ms, responses, out)
         buffer.clear()
 
-    return responses
+    return responses if out is None else out
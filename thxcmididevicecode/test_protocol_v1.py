@@ -5,6 +5,7 @@ import unittest
 
 from thxcmididevicecode.protocol_v1 import (
     PROTOCOL_VERSION,
+    normalize_device_state_candidate,
     process_serial_chunk,
 )
 
@@ -147,6 +148,31 @@ class ProtocolV1Tests(unittest.TestCase):
         self.assertEqual(response["payload"]["status"], "ok")
         self.assertEqual(response["payload"]["state"], self.state)
 
+    def test_state_mutated_in_place_is_revalidated(self):
+        shared_state = copy.deepcopy(self.state)
+        context = self._context()
+        context["get_state"] = lambda: shared_state
+        request = {
+            "v": 1,
+            "type": "get_state",
+            "id": "state-mutated",
+            "ts": self.ts,
+            "payload": {},
+        }
+        frame = (json.dumps(request) + "\n").encode("utf-8")
+
+        first = self._decode_single(process_serial_chunk(self.buffer, frame, context, self.ts))
+        self.assertEqual(first["payload"]["state"], self.state)
+
+        shared_state["notePreset"]["mode"] = "bogus"
+        shared_state["notePreset"]["gradient"]["colorA"] = "#ZZZ"
+        second = self._decode_single(process_serial_chunk(self.buffer, frame, context, self.ts))
+        self.assertEqual(second["type"], "ack")
+        self.assertEqual(second["payload"]["state"]["notePreset"]["mode"], "piano")
+        self.assertEqual(
+            second["payload"]["state"]["notePreset"]["gradient"]["colorA"], "#ff4b5a"
+        )
+
     def test_ping_returns_ack(self):
         request = {
             "v": 1,
@@ -162,6 +188,32 @@ class ProtocolV1Tests(unittest.TestCase):
         self.assertEqual(response["payload"]["status"], "ok")
         self.assertEqual(response["payload"]["pongTs"], self.ts)
 
+    def test_multiple_frames_in_one_chunk_keep_trailing_partial_frame(self):
+        first = {"v": 1, "type": "ping", "id": "ping-a", "ts": self.ts, "payload": {}}
+        second = {"v": 1, "type": "ping", "id": "ping-b", "ts": self.ts, "payload": {}}
+        chunk = (json.dumps(first) + "\r\n" + json.dumps(second) + "\n" + '{"v":1').encode("utf-8")
+
+        responses = process_serial_chunk(self.buffer, chunk, self._context(), self.ts)
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(json.loads(responses[0].decode("utf-8"))["id"], "ping-a")
+        self.assertEqual(json.loads(responses[1].decode("utf-8"))["id"], "ping-b")
+        self.assertEqual(bytes(self.buffer), b'{"v":1')
+
+    def test_pending_buffer_is_trimmed_without_slice_deletion(self):
+        class DeviceBytearray(bytearray):
+            # CircuitPython's bytearray has no item or slice deletion.
+            def __delitem__(self, index):
+                raise TypeError("bytearray does not support deletion")
+
+        buffer = DeviceBytearray(b'{"v":1,')
+        rest = {"type": "ping", "id": "ping-c", "ts": self.ts, "payload": {}}
+        chunk = (json.dumps(rest)[1:] + "\n" + '{"v":1').encode("utf-8")
+        out = DeviceBytearray()
+
+        process_serial_chunk(buffer, chunk, self._context(), self.ts, None, out)
+        self.assertEqual(json.loads(bytes(out).decode("utf-8"))["id"], "ping-c")
+        self.assertEqual(bytes(buffer), b'{"v":1')
+
     def test_apply_config_valid_piano_returns_ack(self):
         next_state = {
             "notePreset": {
@@ -430,6 +482,61 @@ class ProtocolV1Tests(unittest.TestCase):
         self.assertEqual(response["payload"]["code"], "invalid_config")
         self.assertFalse(response["payload"]["retryable"])
 
+    def test_apply_config_non_string_mode_returns_nack(self):
+        invalid_state = copy.deepcopy(self.state)
+        invalid_state["notePreset"]["mode"] = ["piano"]
+
+        request = {
+            "v": 1,
+            "type": "apply_config",
+            "id": "config-bad-mode",
+            "ts": self.ts,
+            "payload": {
+                "configId": "cfg-bad-mode",
+                "idempotencyKey": "idem-bad-mode",
+                "config": invalid_state,
+            },
+        }
+
+        response = self._decode_single(self._send(request))
+        self.assertEqual(response["type"], "nack")
+        self.assertEqual(response["payload"]["code"], "invalid_config")
+
+    def test_apply_config_bool_speed_returns_nack(self):
+        invalid_state = copy.deepcopy(self.state)
+        invalid_state["notePreset"]["rain"]["speed"] = True
+
+        request = {
+            "v": 1,
+            "type": "apply_config",
+            "id": "config-bool-speed",
+            "ts": self.ts,
+            "payload": {
+                "configId": "cfg-bool-speed",
+                "idempotencyKey": "idem-bool-speed",
+                "config": invalid_state,
+            },
+        }
+
+        response = self._decode_single(self._send(request))
+        self.assertEqual(response["type"], "nack")
+        self.assertEqual(response["payload"]["code"], "invalid_config")
+
+    def test_normalize_returns_fresh_tree(self):
+        normalized = normalize_device_state_candidate(self.state)
+        self.assertIsNot(normalized, self.state)
+        self.assertIsNot(normalized["notePreset"], self.state["notePreset"])
+        self.assertEqual(normalized, self.state)
+
+        mixed = copy.deepcopy(self.state)
+        mixed["notePreset"]["gradient"]["colorA"] = "#FF4B5A"
+        mixed["notePreset"]["rain"]["speed"] = 2
+        normalized = normalize_device_state_candidate(mixed)
+        self.assertIsNot(normalized, mixed)
+        self.assertEqual(normalized["notePreset"]["gradient"]["colorA"], "#ff4b5a")
+        self.assertEqual(normalized["notePreset"]["rain"]["speed"], 2.0)
+        self.assertIs(type(normalized["notePreset"]["rain"]["speed"]), float)
+
     def test_apply_config_legacy_show_black_keys_migrates(self):
         legacy_state = {
             "showBlackKeys": False,
@@ -475,6 +582,76 @@ class ProtocolV1Tests(unittest.TestCase):
         self.assertEqual(response["type"], "error")
         self.assertEqual(response["payload"]["code"], "malformed_frame")
 
+    def test_chunk_length_limits_reused_read_buffer(self):
+        request = {"v": 1, "type": "ping", "id": "ping-reused", "ts": self.ts, "payload": {}}
+        frame = (json.dumps(request) + "\n").encode("utf-8")
+        read_block = bytearray(b"\n" * 512)
+        read_block[: len(frame) + 3] = frame + b'{"v'
+
+        responses = process_serial_chunk(
+            self.buffer, read_block, self._context(), self.ts, len(frame) + 3
+        )
+
+        response = self._decode_single(responses)
+        self.assertEqual(response["id"], "ping-reused")
+        self.assertEqual(bytes(self.buffer), b'{"v')
+
+    def test_out_buffer_collects_encoded_frames(self):
+        request = {"v": 1, "type": "ping", "id": "ping-out", "ts": self.ts, "payload": {}}
+        out = bytearray()
+        result = process_serial_chunk(
+            self.buffer,
+            (json.dumps(request) + "\n\n").encode("utf-8"),
+            self._context(),
+            self.ts,
+            out=out,
+        )
+
+        self.assertIs(result, out)
+        lines = bytes(out).split(b"\n")
+        self.assertEqual(lines[-1], b"")
+        self.assertEqual(json.loads(lines[0])["type"], "ack")
+        self.assertEqual(json.loads(lines[1])["payload"]["message"], "Frame is empty.")
+
+    def test_plain_text_line_returns_error_without_json(self):
+        responses = process_serial_chunk(
+            self.buffer,
+            b"soft reboot\r\n",
+            self._context(),
+            self.ts,
+        )
+
+        response = self._decode_single(responses)
+        self.assertEqual(response["type"], "error")
+        self.assertEqual(response["id"], "unmatched")
+        self.assertEqual(response["payload"]["message"], "Frame is not valid JSON.")
+
+    def test_unparseable_array_line_returns_invalid_json_error(self):
+        responses = process_serial_chunk(
+            self.buffer,
+            b'[1,2\n',
+            self._context(),
+            self.ts,
+        )
+
+        response = self._decode_single(responses)
+        self.assertEqual(response["type"], "error")
+        self.assertEqual(response["id"], "unmatched")
+        self.assertEqual(response["payload"]["message"], "Frame is not valid JSON.")
+
+    def test_non_object_line_returns_envelope_error(self):
+        responses = process_serial_chunk(
+            self.buffer,
+            b'["hello", 1]\n',
+            self._context(),
+            self.ts,
+        )
+
+        response = self._decode_single(responses)
+        self.assertEqual(response["type"], "error")
+        self.assertEqual(response["id"], "unmatched")
+        self.assertEqual(response["payload"]["message"], "Envelope must be an object.")
+
     def test_unsupported_type_returns_error(self):
         request = {
             "v": 1,
@@ -489,6 +666,26 @@ class ProtocolV1Tests(unittest.TestCase):
         self.assertEqual(response["id"], "hello-3")
         self.assertEqual(response["payload"]["code"], "unsupported_type")
 
+    def test_missing_callback_nacks_before_payload_validation(self):
+        request = {
+            "v": 1,
+            "type": "firmware_chunk",
+            "id": "chunk-no-endpoint",
+            "ts": self.ts,
+            "payload": {},
+        }
+
+        responses = process_serial_chunk(
+            self.buffer,
+            (json.dumps(request) + "\n").encode("utf-8"),
+            {"capabilities": self.capabilities},
+            self.ts,
+        )
+        response = self._decode_single(responses)
+        self.assertEqual(response["type"], "nack")
+        self.assertEqual(response["payload"]["requestType"], "firmware_chunk")
+        self.assertEqual(response["payload"]["code"], "unsupported_operation")
+
     def test_handler_exception_returns_internal_error(self):
         request = {
             "v": 1,
@@ -550,6 +747,31 @@ class ProtocolV1Tests(unittest.TestCase):
         self.assertEqual(response["payload"]["requestType"], "firmware_begin")
         self.assertEqual(self.firmware_events[0][0], "begin")
 
+    def test_firmware_begin_bool_size_returns_nack(self):
+        request = {
+            "v": 1,
+            "type": "firmware_begin",
+            "id": "fw-begin-bool-size",
+            "ts": self.ts,
+            "payload": {
+                "sessionId": "session-1",
+                "targetVersion": "0.9.4",
+                "files": [
+                    {
+                        "path": "/code.py",
+                        "size": True,
+                        "sha256": "a" * 64,
+                    }
+                ],
+            },
+        }
+
+        response = self._decode_single(self._send(request))
+        self.assertEqual(response["type"], "nack")
+        self.assertEqual(response["payload"]["requestType"], "firmware_begin")
+        self.assertEqual(response["payload"]["code"], "invalid_firmware_update")
+        self.assertEqual(self.firmware_events, [])
+
     def test_firmware_flow_acks(self):
         begin_request = {
             "v": 1,